@@ -30,6 +30,26 @@ read_u32 = lambda f: int.from_bytes(f.read(4), 'little')
 write_u32 = lambda f, x: f.write(x.to_bytes(4, 'little'))
 
 
+def copy_payload(src, dst, progress=None, chunk_size=1024 * 1024):
+    # progress (optional) is called with (bytes copied, bytes total)
+    if progress is None:
+        shutil.copyfileobj(src, dst)
+        return
+
+    start = src.tell()
+    total = src.seek(0, 2) - start
+    src.seek(start)
+
+    copied = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(chunk)
+        copied += len(chunk)
+        progress(copied, total)
+
+
 def format_marker_list(ml):
     if ml is None:
         return
@@ -116,17 +136,22 @@ def encode(args, pre=False):
         write_u32(of, of.tell() + 8)
         write_u32(of, data_offset)
 
-        shutil.copyfileobj(args.file, of)
+        copy_payload(args.file, of, getattr(args, 'progress', None))
 
     args.file.close()
 
 
-def replace(args):
+def replace(args, base_info=None):
     mi = lambda: None
 
-    mi.file = args.base
-    mi = info(mi, prnt=False)
-    args.base.close()
+    if base_info is None:
+        mi.file = args.base
+        mi = info(mi, prnt=False)
+        args.base.close()
+    else:
+        # header fields of the base file, as parsed by info() earlier
+        for a, v in base_info.items():
+            setattr(mi, a, v)
 
     with wave.open(args.file) as w:
         params = w.getparams()
@@ -150,26 +175,22 @@ def decode(args):
     info(args, prnt=False)
 
     with open(args.out, 'wb') as of:
-        shutil.copyfileobj(args.file, of)
+        copy_payload(args.file, of, getattr(args, 'progress', None))
 
     args.file.close()
 
 
-def info(args, prnt=True):
-    f = args.file
-
+def read_header(f):
+    # Reads the header only, front to back (so f may also be a stream that cannot seek).
+    # Returns (mi, sizes): sizes is None for a srch stub (mi only has its id),
+    # else (file_size, header_size, data_offset).
     magic = f.read(4)
     if magic == b'srch':
         assert read_u32(f) == 8 # always 8
-        sid = read_u32(f)
+        mi = lambda: None
+        mi.id = read_u32(f)
         assert read_u32(f) == 1 # always 1
-
-        if prnt:
-            print(SRCH_INFO % sid)
-        else:
-            raise ValueError("srch files contain no audio data")
-
-        return
+        return mi, None
     elif magic != b'srcd':
         raise ValueError("not a valid asrc file")
 
@@ -214,6 +235,27 @@ def info(args, prnt=True):
     header_size = read_u32(f)
     data_offset = read_u32(f)
 
+    mi.soff = mi.samples % mi.channels != 0
+    if mi.soff:
+        mi.samples -= 1
+
+    return mi, (file_size, header_size, data_offset)
+
+
+def info(args, prnt=True, out=None):
+    f = args.file
+
+    mi, sizes = read_header(f)
+    if sizes is None:
+        if prnt:
+            print(SRCH_INFO % mi.id, file=out)
+        else:
+            raise ValueError("srch files contain no audio data")
+
+        return
+
+    file_size, header_size, data_offset = sizes
+
     assert header_size == f.tell()
 
     f.seek(0, 2)
@@ -225,10 +267,6 @@ def info(args, prnt=True):
     assert data_offset == f.tell() - header_size
     f.seek(header_size)
 
-    mi.soff = mi.samples % mi.channels != 0
-    if mi.soff:
-        mi.samples -= 1
-
     assert mi.channels == params.nchannels
     assert mi.samples == params.nframes * params.nchannels
     assert mi.rate == params.framerate
@@ -238,7 +276,7 @@ def info(args, prnt=True):
         mi.mark = format_marker_list(mi.mark)
         print(SRCD_INFO % (mi.id, mi.unk0, mi.unk1, mi.urate,
             mi.soff, mi.strm, mi.loop, mi.lps, mi.lpe, mi.mark,
-            mi.channels, mi.samples, mi.rate, mi.depth))
+            mi.channels, mi.samples, mi.rate, mi.depth), file=out)
 
         f.close()
 
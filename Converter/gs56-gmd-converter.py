@@ -4,10 +4,16 @@
 import argparse
 import ast
 import glob
+import io
+import math
+import mmap
 import os
 import re
 import struct
+import sys
+import threading
 import zlib
+from collections import OrderedDict
 
 
 GMD_VERSIONS = {
@@ -143,24 +149,43 @@ def calculate_hash(label_name, encoding='utf-8'):
     return inverted_hash1, inverted_hash2
 
 
-def xor_cipher(data, version=1):
+XOR_KEYS = {
+    1: ("fjfajfahajra;tira9tgujagjjgajgoa", "mva;eignhpe/dfkfjgp295jtugkpejfu"),
+    2: ("e43bcc7fcab+a6c4ed22fcd433/9d2e6cb053fa462-463f3a446b19", "861f1dca05a0;9ddd5261e5dcc@6b438e6c.8ba7d71c*4fd11f3af1")
+}
+
+# Combined keystream per version, built on first use
+_keystreams = {}
+
+
+def xor_keystream(version=1):
+    """
+    Returns key1 XOR key2 of a version over one full period (the LCM of the key lengths),
+    after which the combined key repeats.
+    """
+    if version not in _keystreams:
+        if version not in XOR_KEYS:
+            raise ValueError("Invalid version")
+        key1, key2 = XOR_KEYS[version]
+        period = len(key1) * len(key2) // math.gcd(len(key1), len(key2))
+        _keystreams[version] = bytes(ord(key1[i % len(key1)]) ^ ord(key2[i % len(key2)]) for i in range(period))
+    return _keystreams[version]
+
+
+def xor_cipher(data, version=1, offset=0):
     """
     Applies XOR cipher to the input data based on version.
+    offset is the position of the data in the section content (to decrypt a part of it on its own).
     """
-    if version == 1:
-        key1 = "fjfajfahajra;tira9tgujagjjgajgoa"
-        key2 = "mva;eignhpe/dfkfjgp295jtugkpejfu"
-    elif version == 2:
-        key1 = "e43bcc7fcab+a6c4ed22fcd433/9d2e6cb053fa462-463f3a446b19"
-        key2 = "861f1dca05a0;9ddd5261e5dcc@6b438e6c.8ba7d71c*4fd11f3af1"
-    else:
-        raise ValueError("Invalid version")
+    keystream = xor_keystream(version)
+    shift = offset % len(keystream)
+    if shift:
+        keystream = keystream[shift:] + keystream[:shift]
 
-    # Apply XOR to data using the two keys
-    result = bytearray()
-    for i, byte in enumerate(data):
-        result.append(byte ^ ord(key1[i % len(key1)]) ^ ord(key2[i % len(key2)]))
-    return bytes(result)
+    # Repeat the keystream over the data and XOR both in one go, as big integers
+    size = len(data)
+    stream = (keystream * (size // len(keystream) + 1))[:size]
+    return (int.from_bytes(data, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(size, 'little')
 
 
 def is_plaintext(data):
@@ -176,14 +201,14 @@ def is_plaintext(data):
         return False
 
 
-def process_content(file, section_size):
+def process_content(content, source=None):
     """
-    Reads and processes content to detect if it's plaintext or encrypted.
-    Tries to decrypt with XOR if content doesn't look like plaintext.
+    Processes the section content (bytes or a memoryview) to detect if it's plaintext or encrypted.
+    Tries to decrypt with XOR if content doesn't look like plaintext. source names the file in warnings.
     """
     try:
-        # Read the content
-        ciphertext = bytearray(file.read(section_size))
+        # Copy the content
+        ciphertext = bytearray(content)
         
         # Check if the content is plaintext
         if is_plaintext(ciphertext):
@@ -198,8 +223,7 @@ def process_content(file, section_size):
 
         # Check if there's any content
         if len(ciphertext) == 0:
-            filename = os.path.basename(file.name) if hasattr(file, 'name') else str(file)
-            print(f"WARNING: Section content of '{filename}' is empty.")
+            print(f"WARNING: Section content of '{source}' is empty.")
             plaintext = bytearray()
             return plaintext
 
@@ -212,117 +236,429 @@ def process_content(file, section_size):
         return None
 
 
-def parse_gmd_file(file_path, is_le=True, label_sep='<SEC_END>', hash_table_size=1024, encoding='utf-8'):
+# Bytes per label table entry, per GMD version
+LABEL_ENTRY_SIZES = {
+    1: 8,   # label number, pointer value
+    2: 20   # label number, hash1, hash2, label start index, unknown label reference
+}
+
+
+def unpack_label_table(table, version, label_count, is_le=True):
+    """Unpacks a whole label table (bytes or memoryview) at once.
+
+    Returns:
+        (label_offsets, label_ref1, label_ref2): label_offsets holds the label number and pointer value
+        (V1) or the label number, hash1 and hash2 (V2) of every label, one after another.
+        label_ref1 and label_ref2 are None for V1.
     """
-    This processes the GMD file (first part of decoding).
+    fields = LABEL_ENTRY_SIZES[version] // 4
+    values = struct.unpack(f"{'<' if is_le else '>'}{label_count * fields}I", table)
+
+    if version == 1:
+        return list(values), None, None
+
+    # Keep the first three columns interleaved, the other two as their own lists
+    label_offsets = [0] * (label_count * 3)
+    label_offsets[0::3] = values[0::5]
+    label_offsets[1::3] = values[1::5]
+    label_offsets[2::3] = values[2::5]
+    return label_offsets, list(values[3::5]), list(values[4::5])
+
+
+# Bytes read at a time when label_size is too small for the label names
+LABEL_READ_SIZE = 4096
+
+
+def split_label_names(block, label_offsets, label_count, encoding='utf-8'):
+    """Splits a block of NUL-terminated label names (bytes or memoryview) at once.
+
+    Labels whose pointer value is 0 have no name in the block and are named "NO_LABEL".
+
+    Returns:
+        (label_names, end) with end the offset after the last name's terminator,
+        or None if the block does not hold every name.
     """
-    try:
-        with open(file_path, 'rb') as file:
-            # Validate file size
-            file.seek(0, 2)  # Move to the end of the file
-            file_size = file.tell()
-            file.seek(0)  # Reset to the start
+    has_name = [label_offsets[2 * i + 1] != 0x0 for i in range(label_count)]  # Pointer value at even indices
+    name_count = sum(has_name)
+    block = bytes(block)
+    if block.count(b'\x00') < name_count:
+        return None
 
-            if file_size < 40:
-                raise ValueError(f"File too small: {file_size} bytes, expected at least 40 bytes")
+    parts = block.split(b'\x00', name_count)
+    end = len(block) - len(parts[-1]) if name_count else 0
+    names = iter(parts)
+    return [next(names).decode(encoding) if named else "NO_LABEL" for named in has_name], end
 
-            # Read and parse the header in one step
-            magic, version, language, unknown1, unknown2, label_count, section_count, label_size, section_size, name_size = read_data(file, is_le=is_le, fmt_types='4sIIIIIIIII')
 
-            # Check for magic word
-            if magic != b'GMD\x00':
-                raise ValueError("Invalid GMD file: Magic word mismatch")
+# Header fields: magic, version, language, unknown1, unknown2, label_count, section_count, label_size, section_size, name_size
+HEADER_FORMAT = '4sIIIIIIIII'
+HEADER_SIZE = struct.calcsize('<' + HEADER_FORMAT)
 
-            # Read the filename
-            filename = file.read(name_size).decode(encoding).rstrip('\x00')
 
-            # Skip the null terminator after the filename
-            file.seek(1, 1)
+def parse_hash_table(hash_table, hash_table_size=1024):
+    """
+    Collects the label index positions and FF FF FF FF markers of a V2 hash table.
+    """
+    # Store the hash table's positions
+    label_map = {
+        "label_data": [],  # To store tuples of (position, value)
+        "ff_marker": []    # To store tuple of FF FF FF FF
+    }
+    hash_table = bytes(hash_table)
 
-            # Convert version to be 1 or 2
-            version = convert_gmd_version(version)
+    # Iterate through the block, 4 bytes at a time
+    for i in range(0, hash_table_size, 4):
+        chunk = hash_table[i:i + 4]
 
-            # Convert the language
-            language = convert_lang(language)
+        # Check if it's FF FF FF FF
+        if chunk == b'\xFF\xFF\xFF\xFF':
+            label_value = int.from_bytes(chunk, byteorder='little', signed=False)
+            label_map["ff_marker"].append((i, label_value))
 
-            label_offsets = []
-
-            if version == 1:  # GMD V1 (Dual Destinies)
-                # Parse the offsets for the label pointer table
-                for _ in range(label_count):
-                    # First offset is the label number
-                    offset = read_data(file, is_le=is_le, fmt_types='I')[0]
-                    label_offsets.append(offset)
-                    # Second offset is the pointer value
-                    offset = read_data(file, is_le=is_le, fmt_types='I')[0]
-                    label_offsets.append(offset)
-            elif version == 2:  # GMD V2 (Spirit of Justice)
-                label_ref1 = []
-                label_ref2 = []
-
-                # Parse the offsets for the label table
-                for _ in range(label_count):
-                    # First offset is the label number
-                    offset = read_data(file, is_le=is_le, fmt_types='I')[0]
-                    label_offsets.append(offset)
-                    # Second offset is the hash1
-                    offset = read_data(file, is_le=is_le, fmt_types='I')[0]
-                    label_offsets.append(offset)
-                    # Third offset is the hash2
-                    offset = read_data(file, is_le=is_le, fmt_types='I')[0]
-                    label_offsets.append(offset)
-                    # Skip 8 bytes to get to the next entry
-                    #file.seek(8, 1)
-                    # Label start position index (within all the labels)
-                    offset = read_data(file, is_le=is_le, fmt_types='I')[0]
-                    label_ref1.append(offset)
-                    # Unknown label reference (maybe to another label index in the hash table?)
-                    offset = read_data(file, is_le=is_le, fmt_types='I')[0]
-                    label_ref2.append(offset)
-
-                # Store the hash table's positions
-                label_map = {
-                    "label_data": [],  # To store tuples of (position, value)
-                    "ff_marker": []    # To store tuple of FF FF FF FF
-                }
-
-                # Read the hash map in its entirety
-                hash_table = file.read(hash_table_size)
-
-                # Iterate through the block, 4 bytes at a time
-                for i in range(0, hash_table_size, 4):
-                    chunk = hash_table[i:i + 4]
-
-                    # Check if it's FF FF FF FF
-                    if chunk == b'\xFF\xFF\xFF\xFF':
-                        label_value = int.from_bytes(chunk, byteorder='little', signed=False)
-                        label_map["ff_marker"].append((i, label_value))
-
-                    # Collect label index positions
-                    if chunk != b'\x00\x00\x00\x00' and chunk != b'\xFF\xFF\xFF\xFF':  # Skip zero entries and the FF FF FF FF marker
-                        label_value = int.from_bytes(chunk, byteorder='little', signed=False)
-                        label_map["label_data"].append((i, label_value))
-            else:
-                raise ValueError("Unsupported GMD version")
+        # Collect label index positions
+        if chunk != b'\x00\x00\x00\x00' and chunk != b'\xFF\xFF\xFF\xFF':  # Skip zero entries and the FF FF FF FF marker
+            label_value = int.from_bytes(chunk, byteorder='little', signed=False)
+            label_map["label_data"].append((i, label_value))
 
-            # Parse the label names
-            label_names = []
-            for i in range(label_count):
-                # Check if the offset for this label is 0x0
-                if label_offsets[2 * i + 1] == 0x0:  # Pointer value at even indices
-                    label_names.append("NO_LABEL")
+    return label_map
+
+
+def build_header_data(header, filename, labels, label_map, label_names, encoding='utf-8'):
+    """
+    Builds the dictionary of everything before the section content.
+    header holds the header fields (version and language converted), labels is what unpack_label_table() returns.
+    """
+    magic, version, language, unknown1, unknown2, label_count, section_count, label_size, section_size, name_size = header
+    label_offsets, label_ref1, label_ref2 = labels
+
+    # Base dictionary that is common for both versions
+    base_data = {
+        "magic": magic.decode(encoding),
+        "version": version,
+        "language": language,
+        "unknown1": unknown1,
+        "unknown2": unknown2,
+        "label_count": label_count,
+        "section_count": section_count,
+        "label_size": label_size,
+        "section_size": section_size,
+        "name_size": name_size,
+        "filename": filename,
+        "label_offsets": label_offsets,
+    }
+
+    # For version 2, add the extra fields
+    if version == 2:
+        # Reset label map if there is no label
+        if label_count == 0:
+            label_map.clear()
+
+        base_data["label_ref1"] = label_ref1
+        base_data["label_ref2"] = label_ref2
+        base_data["label_map"] = label_map
+
+    base_data["label_names"] = label_names
+    return base_data
+
+
+def convert_header(fields):
+    """
+    Checks the unpacked header fields and converts the version (to 1 or 2) and language.
+    """
+    magic, version, language = fields[:3]
+
+    # Check for magic word
+    if magic != b'GMD\x00':
+        raise ValueError("Invalid GMD file: Magic word mismatch")
+
+    version = convert_gmd_version(version)
+    if version not in LABEL_ENTRY_SIZES:
+        raise ValueError("Unsupported GMD version")
+    return (magic, version, convert_lang(language)) + tuple(fields[3:])
+
+
+def read_gmd_header(file, is_le=True, hash_table_size=1024, encoding='utf-8'):
+    """
+    Reads everything before the section content: the header, file name, label tables and label names.
+    Reads front to back only, so the file may also be a stream (e.g. an upload still arriving),
+    only a file that can seek is put back to the end of the label names if label_size overshoots.
+    GmdFile reads the same from a file on disk without copying it.
+    """
+    # Read and parse the header in one step
+    header = convert_header(read_data(file, is_le=is_le, fmt_types=HEADER_FORMAT))
+    version, label_count, label_size, name_size = header[1], header[5], header[7], header[9]
+
+    # Read the filename
+    filename = file.read(name_size).decode(encoding).rstrip('\x00')
+
+    # Skip the null terminator after the filename
+    file.read(1)
+
+    # Read the label table in one slice and unpack it in one call
+    entry_size = LABEL_ENTRY_SIZES[version]
+    label_table = file.read(label_count * entry_size)
+    if len(label_table) < label_count * entry_size:
+        raise ValueError("Unexpected end of file while reading the label table")
+    labels = unpack_label_table(label_table, version, label_count, is_le)
+
+    label_map = None
+    if version == 2:  # GMD V2 (Spirit of Justice)
+        # Read the hash map in its entirety
+        label_map = parse_hash_table(file.read(hash_table_size), hash_table_size)
+
+    # Read the label names in one block. label_size can be off (e.g. for non-ASCII names),
+    # so read on while names are missing, and step back to the end of the last one.
+    block = file.read(label_size)
+    names = split_label_names(block, labels[0], label_count, encoding)
+    while names is None:
+        more = file.read(LABEL_READ_SIZE)
+        if not more:
+            raise ValueError("Unexpected end of file while reading label names")
+        block += more
+        names = split_label_names(block, labels[0], label_count, encoding)
+    label_names, names_end = names
+    if names_end < len(block) and file.seekable():
+        file.seek(names_end - len(block), 1)
+
+    return build_header_data(header, filename, labels, label_map, label_names, encoding)
+
+
+class GmdFile:
+    """
+    A GMD file read in place: files on disk are memory-mapped, and the header, label table,
+    hash table (V2) and section blob are memoryview slices of the mapping, so only the pages
+    that are used are ever read. In-memory files (which cannot be mapped) are used through
+    their buffer, or read into memory.
+    The label names (and with them the start of the sections) are read on first use.
+    """
+
+    def __init__(self, file_path, is_le=True, hash_table_size=1024, encoding='utf-8'):
+        self.is_le = is_le
+        self.encoding = encoding
+        self.shared = False
+        self._mmap = None
+        self._label_names = None
+        self._labels = None
+        self._section_index = None
+        self.header = self.label_table = self.hash_table = None
+
+        if hasattr(file_path, 'read'):
+            self.name = os.path.basename(file_path.name) if hasattr(file_path, 'name') else str(file_path)
+            if hasattr(file_path, 'getbuffer'):
+                self.data = file_path.getbuffer()
+            else:
+                file_path.seek(0)
+                self.data = memoryview(file_path.read())
+        else:
+            self.name = os.path.basename(file_path)
+            with open(file_path, 'rb') as file:
+                if os.fstat(file.fileno()).st_size:
+                    self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.data = memoryview(self._mmap)
                 else:
-                    label = b""
-                    while True:
-                        char = file.read(1)
-                        if char == b'\x00':  # Null terminator indicates the end of the label
-                            break
-                        label += char
-                    label_names.append(label.decode(encoding))  # Decode the label to a string
+                    # An empty file cannot be mapped
+                    self.data = memoryview(b"")
+
+        try:
+            self._parse_layout(hash_table_size)
+        except BaseException:
+            self.close()
+            raise
+
+    def _parse_layout(self, hash_table_size):
+        file_size = len(self.data)
+        if file_size < HEADER_SIZE:
+            raise ValueError(f"File too small: {file_size} bytes, expected at least {HEADER_SIZE} bytes")
+
+        self.header = self.data[:HEADER_SIZE]
+        self.fields = convert_header(struct.unpack_from(('<' if self.is_le else '>') + HEADER_FORMAT, self.header))
+        (_, self.version, self.language, _, _, self.label_count, self.section_count,
+         self.label_size, self.section_size, name_size) = self.fields
+        self.filename = bytes(self.data[HEADER_SIZE:HEADER_SIZE + name_size]).decode(self.encoding).rstrip('\x00')
+
+        # The label table follows the file name and its null terminator
+        start = HEADER_SIZE + name_size + 1
+        end = start + self.label_count * LABEL_ENTRY_SIZES[self.version]
+        if end > file_size:
+            raise ValueError("Unexpected end of file while reading the label table")
+        self.label_table = self.data[start:end]
+
+        if self.version == 2:
+            self.hash_table = self.data[end:end + hash_table_size]
+            end += len(self.hash_table)
+        self._hash_table_size = hash_table_size
+        self._names_start = end
+
+    @property
+    def labels(self):
+        """(label_offsets, label_ref1, label_ref2) as unpack_label_table() returns them."""
+        if self._labels is None:
+            self._labels = unpack_label_table(self.label_table, self.version, self.label_count, self.is_le)
+        return self._labels
+
+    def _read_label_names(self):
+        # label_size can be off (e.g. for non-ASCII names), so look further while names are missing
+        end = self._names_start + self.label_size
+        while True:
+            names = split_label_names(self.data[self._names_start:end], self.labels[0], self.label_count, self.encoding)
+            if names is not None:
+                break
+            if end >= len(self.data):
+                raise ValueError("Unexpected end of file while reading label names")
+            end += LABEL_READ_SIZE
+        self._label_names, names_end = names
+        self._sections_start = self._names_start + names_end
+
+    @property
+    def label_names(self):
+        if self._label_names is None:
+            self._read_label_names()
+        return self._label_names
+
+    @property
+    def sections(self):
+        """The section content as stored (possibly XOR'd), with its null terminators."""
+        if self._label_names is None:
+            self._read_label_names()
+        return self.data[self._sections_start:self._sections_start + self.section_size]
+
+    def _build_section_index(self):
+        # Tell plaintext from XOR'd content like process_content() does, and note where every section starts
+        content = bytes(self.sections)
+        self._encrypted = False
+        if not is_plaintext(content):
+            plaintext = xor_cipher(content)
+            if is_plaintext(plaintext):
+                content = plaintext
+                self._encrypted = True
+
+        starts = [0]
+        for part in content.split(b'\x00'):
+            starts.append(starts[-1] + len(part) + 1)
+        self._section_starts = starts
+
+        # The first section of each label name
+        index = {}
+        for idx, label in enumerate(self.label_names[:len(starts) - 1]):
+            index.setdefault(label, idx)
+        self._section_index = index
+
+    def section_text(self, idx, label_sep='<SEC_END>'):
+        """
+        Returns the text of the section at idx as parse_gmd_file() puts it in section_content,
+        decoding (and decrypting) only that section.
+        """
+        if self._section_index is None:
+            self._build_section_index()
+        start = self._section_starts[idx]
+        end = min(self._section_starts[idx + 1] - 1, self.section_size)
+        window = self.sections[start:end]
+        data = xor_cipher(window, offset=start) if self._encrypted else bytes(window)
+        window.release()
+        return (data.decode(self.encoding).replace('\r\n', '\n') + label_sep).strip()
+
+    def get(self, label_name, default=None, label_sep='<SEC_END>'):
+        """
+        Returns the text of a label's section (the first one, if the name repeats) or default.
+        The section index is built on first use, after that only the requested section is read.
+        """
+        if self._section_index is None:
+            self._build_section_index()
+        idx = self._section_index.get(label_name)
+        if idx is None:
+            return default
+        return self.section_text(idx, label_sep)
+
+    def header_data(self):
+        """
+        Returns the dictionary read_gmd_header() returns.
+        """
+        label_map = parse_hash_table(self.hash_table, self._hash_table_size) if self.version == 2 else None
+        return build_header_data(self.fields, self.filename, self.labels, label_map, self.label_names, self.encoding)
+
+    def close(self):
+        # A file shared by open_gmd() stays open for the next lookups
+        if not self.shared:
+            self._release()
+
+    def _release(self):
+        for view in (self.header, self.label_table, self.hash_table, self.data):
+            if view is not None:
+                view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Slices are still in use elsewhere, the mapping is closed once they are gone
+                pass
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Files opened by open_gmd(), kept open (with their section index) for the next lookups,
+# least recently used first
+OPEN_GMD_CACHE_SIZE = 16
+_open_files = OrderedDict()
+_open_files_lock = threading.Lock()
+
+
+def open_gmd(file_path, is_le=True, hash_table_size=1024, encoding='utf-8'):
+    """
+    Opens a GMD file for looking up single labels, e.g. open_gmd(path).get(label_name).
+    A file on disk stays open for the next calls with the same path, until it changes or
+    OPEN_GMD_CACHE_SIZE other files are opened, so its section index is only built once and
+    each lookup decodes just the requested section. Closing it is left to open_gmd()
+    (see close_gmd_files()).
+    """
+    if hasattr(file_path, 'read'):
+        return GmdFile(file_path, is_le=is_le, hash_table_size=hash_table_size, encoding=encoding)
+
+    st = os.stat(file_path)
+    key = (os.path.realpath(file_path), is_le, hash_table_size, encoding)
+    version = (st.st_ino, st.st_size, st.st_mtime_ns)
+    with _open_files_lock:
+        cached = _open_files.get(key)
+        if cached and cached[0] == version:
+            _open_files.move_to_end(key)
+            return cached[1]
+
+        # New, changed on disk since it was opened, or dropped. A file dropped from the cache
+        # is unmapped once no caller holds it any more.
+        gmd = GmdFile(file_path, is_le=is_le, hash_table_size=hash_table_size, encoding=encoding)
+        gmd.shared = True
+        _open_files[key] = (version, gmd)
+        _open_files.move_to_end(key)
+        while len(_open_files) > OPEN_GMD_CACHE_SIZE:
+            _open_files.popitem(last=False)
+        return gmd
+
+
+def close_gmd_files():
+    """
+    Closes the files open_gmd() keeps open.
+    """
+    with _open_files_lock:
+        while _open_files:
+            _open_files.popitem()[1][1]._release()
 
 
+def parse_gmd_file(file_path, is_le=True, label_sep='<SEC_END>', hash_table_size=1024, encoding='utf-8'):
+    """
+    This processes the GMD file (first part of decoding).
+    """
+    try:
+        with GmdFile(file_path, is_le=is_le, hash_table_size=hash_table_size, encoding=encoding) as gmd:
+            base_data = gmd.header_data()
+            label_names = base_data["label_names"]
+            section_count = base_data["section_count"]
+
             # Process the main content
-            processed_content = process_content(file, section_size)
+            processed_content = process_content(gmd.sections, gmd.name)
             if processed_content is not None:
                 plaintext = processed_content
             else:
@@ -353,50 +689,18 @@ def parse_gmd_file(file_path, is_le=True, label_sep='<SEC_END>', hash_table_size
                 # Add the label and its content as a pair to the dictionary
                 section_content[f"{idx}:{label}"] = content_with_marker.strip()
 
-            # Base dictionary that is common for both versions
-            base_data = {
-                "magic": magic.decode(encoding),
-                "version": version,
-                "language": language,
-                "unknown1": unknown1,
-                "unknown2": unknown2,
-                "label_count": label_count,
-                "section_count": section_count,
-                "label_size": label_size,
-                "section_size": section_size,
-                "name_size": name_size,
-                "filename": filename,
-                "label_offsets": label_offsets,
-            }
-
-            # For version 1, return the base dictionary directly
-            if version == 1:
-                base_data["label_names"] = label_names
-                base_data["section_content"] = section_content
-                return base_data
-
-            # For version 2, add the extra fields
-            elif version == 2:
-                # Reset label map if there is no label
-                if label_count == 0:
-                    label_map.clear()
-
-                base_data["label_ref1"] = label_ref1
-                base_data["label_ref2"] = label_ref2
-                base_data["label_map"] = label_map
-                base_data["label_names"] = label_names
-                base_data["section_content"] = section_content
-
-                return base_data
+            base_data["section_content"] = section_content
+            return base_data
 
     except Exception as e:
         print(f"Error parsing GMD file: {e}")
         return None
 
 
-def write_gmd_data_to_file(gmd_data, output_file, encoding='utf-8'):
+def write_gmd_data_to_file(gmd_data, output_file, encoding='utf-8', progress=None):
     """
     Writes the parsed GMD data to a readable text file.
+    progress (optional) is called with (labels processed, label count).
     """
     try:
         with open(output_file, 'w', encoding=encoding) as file:
@@ -457,6 +761,9 @@ def write_gmd_data_to_file(gmd_data, output_file, encoding='utf-8'):
                     else f"{{{idx}:{label_offset}:{label}}}\n{section_data}\n"
                 )
 
+                if progress:
+                    progress(idx + 1, len(label_names))
+
             # Write everything in one go
             file.writelines(content)
 
@@ -472,8 +779,12 @@ def read_decoded_text_file(input_file, encoding='utf-8'):
         "labels": []  # To store label data (index, offset, name, content)
     }
     try:
-        with open(input_file, 'r', encoding=encoding) as file:
-            lines = file.readlines()
+        if hasattr(input_file, 'read'):
+            # Binary file object (e.g. an in-memory upload), with universal newlines like open()
+            lines = io.StringIO(input_file.read().decode(encoding), newline=None).readlines()
+        else:
+            with open(input_file, 'r', encoding=encoding) as file:
+                lines = file.readlines()
 
         # Parse header fields
         gmd_data['filename'] = lines[0].strip().strip('{}')  # First line: filename
@@ -558,9 +869,10 @@ def replace_fullwidth_with_placeholder(text):
     return ''.join(result)
 
 
-def write_gmd_file(output_file, gmd_data, is_le=True, xor_encoding=False, label_sep='<SEC_END>', MAX_HASH_SIZE=1024, encoding='utf-8'):
+def write_gmd_file(output_file, gmd_data, is_le=True, xor_encoding=False, label_sep='<SEC_END>', MAX_HASH_SIZE=1024, encoding='utf-8', progress=None):
     """
     Write the processed data back to a GMD file as binary.
+    progress (optional) is called with (labels processed, label count).
     """
     try:
         with open(output_file, 'wb') as file:
@@ -654,6 +966,9 @@ def write_gmd_file(output_file, gmd_data, is_le=True, xor_encoding=False, label_
                     # Add to the section size
                     section_size += len(cur_content)
 
+                if progress:
+                    progress(len(label_names), len(gmd_data['labels']))
+
             # Make sure the label count is sufficient
             if label_count == len(label_names):
                 # Get all label strings for reference
@@ -778,6 +1093,70 @@ def write_gmd_file(output_file, gmd_data, is_le=True, xor_encoding=False, label_
         print(f"Error writing binary GMD file: {e}")
 
 
+def write_gmd_info(gmd_data, outfile):
+    """
+    Writes the raw, unprocessed GMD data as "key: value" lines.
+    """
+    for key, value in gmd_data.items():
+        if key == "content":
+            outfile.write(f"{key}: {len(value)} bytes\n")
+        else:
+            outfile.write(f"{key}: {value}\n")
+
+
+def warm():
+    """
+    Compiles and builds everything the conversions create on first use (called when a server loads the converter).
+    """
+    is_plaintext(b"<E001 0>")
+    calculate_hash("LBL_000")
+    for version in XOR_KEYS:
+        xor_keystream(version)
+
+
+def info_gmd_file(input_file, output_file=None, is_le=True, label_sep='<SEC_END>', MAX_HASH_SIZE=1024, encoding='utf-8'):
+    """
+    Writes the raw GMD data to the output file (or prints it, if there is none).
+    Returns True on success.
+    """
+    gmd_data = parse_gmd_file(input_file, is_le=is_le, label_sep=label_sep, hash_table_size=MAX_HASH_SIZE, encoding=encoding)
+    if not gmd_data:
+        return False
+
+    if output_file:
+        with open(output_file, "w", encoding=encoding) as outfile:
+            write_gmd_info(gmd_data, outfile)
+    else:
+        write_gmd_info(gmd_data, sys.stdout)
+    return True
+
+
+def decode_gmd_file(input_file, output_file, is_le=True, label_sep='<SEC_END>', MAX_HASH_SIZE=1024, encoding='utf-8', progress=None):
+    """
+    Decodes a GMD file to a readable text file.
+    Returns True on success.
+    """
+    gmd_data = parse_gmd_file(input_file, is_le=is_le, label_sep=label_sep, hash_table_size=MAX_HASH_SIZE, encoding=encoding)
+    if not gmd_data:
+        return False
+
+    write_gmd_data_to_file(gmd_data, output_file, encoding=encoding, progress=progress)
+    return True
+
+
+def encode_gmd_file(input_file, output_file, is_le=True, xor_encoding=False, label_sep='<SEC_END>', MAX_HASH_SIZE=1024, encoding='utf-8', progress=None):
+    """
+    Encodes a readable text file back to a GMD file.
+    Returns True on success.
+    """
+    gmd_data = read_decoded_text_file(input_file, encoding=encoding)
+    if not gmd_data:
+        return False
+
+    write_gmd_file(output_file, gmd_data, is_le=is_le, xor_encoding=xor_encoding, label_sep=label_sep, MAX_HASH_SIZE=MAX_HASH_SIZE, encoding=encoding, progress=progress)
+    return True
+
+
 def main():
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Convert PW:AA - Dual Destinies (GS5) and PW:AA - Spirit of Justice (GS6) GMD scripts")
@@ -822,32 +1201,18 @@ def main():
         is_le = not args.be
         input_files = glob.glob(args.input_file)
         for input_file in input_files:
-            output_file = args.output_file if args.output_file else f"{os.path.splitext(input_file)[0]}-raw.txt"
-            gmd_data = parse_gmd_file(input_file, is_le=is_le, label_sep=label_sep, hash_table_size=MAX_HASH_SIZE, encoding=encoding)
             if args.out:
-                if gmd_data:
-                    with open(output_file, "w", encoding=encoding) as outfile:
-                        for key, value in gmd_data.items():
-                            if key == "content":
-                                outfile.write(f"{key}: {len(value)} bytes\n")
-                            else:
-                                outfile.write(f"{key}: {value}\n")
-                        print(f'Converted "{input_file}" to raw readable format: "{output_file}"')
+                output_file = args.output_file if args.output_file else f"{os.path.splitext(input_file)[0]}-raw.txt"
+                if info_gmd_file(input_file, output_file, is_le=is_le, label_sep=label_sep, MAX_HASH_SIZE=MAX_HASH_SIZE, encoding=encoding):
+                    print(f'Converted "{input_file}" to raw readable format: "{output_file}"')
             else:
-                if gmd_data:
-                    for key, value in gmd_data.items():
-                        if key == "content":
-                            print(f"{key}: {len(value)} bytes")
-                        else:
-                            print(f"{key}: {value}")
+                info_gmd_file(input_file, is_le=is_le, label_sep=label_sep, MAX_HASH_SIZE=MAX_HASH_SIZE, encoding=encoding)
     elif args.command == "d":  # Decode
         is_le = not args.be
         input_files = glob.glob(args.input_file)
         for input_file in input_files:
             output_file = args.output_file if args.output_file else f"{os.path.splitext(input_file)[0]}.txt"
-            gmd_data = parse_gmd_file(input_file, is_le=is_le, label_sep=label_sep, hash_table_size=MAX_HASH_SIZE, encoding=encoding)
-            if gmd_data:
-                write_gmd_data_to_file(gmd_data, output_file, encoding=encoding)
+            if decode_gmd_file(input_file, output_file, is_le=is_le, label_sep=label_sep, MAX_HASH_SIZE=MAX_HASH_SIZE, encoding=encoding):
                 print(f'Converted "{input_file}" to readable format: "{output_file}"')
     elif args.command == "e":  # Encode
         is_le = not args.be
@@ -855,9 +1220,7 @@ def main():
         input_files = glob.glob(args.input_file)
         for input_file in input_files:
             output_file = args.output_file if args.output_file else f"{os.path.splitext(input_file)[0]}.gmd"
-            gmd_data = read_decoded_text_file(input_file, encoding=encoding)
-            if gmd_data:
-                write_gmd_file(output_file, gmd_data, is_le=is_le, xor_encoding=xor_encoding, label_sep=label_sep, MAX_HASH_SIZE=MAX_HASH_SIZE, encoding=encoding)
+            if encode_gmd_file(input_file, output_file, is_le=is_le, xor_encoding=xor_encoding, label_sep=label_sep, MAX_HASH_SIZE=MAX_HASH_SIZE, encoding=encoding):
                 print(f'Converted "{input_file}" back to GMD format: "{output_file}"')
 
 
@@ -3,6 +3,7 @@
 
 import argparse
 import glob
+import io
 import json
 import re
 import os
@@ -821,32 +822,54 @@ def json_to_text(json_data, isGMD=True, isSOJ=False, isTagsKeep=False):
     return result.strip()
 
 
-# Function to process each file (for multiprocessing)
-def process_file(file, args):
+# Function to fill the regex cache (called when a server loads the converter)
+def warm():
+    """Runs every conversion once on a tiny sample, so its patterns are compiled before the first request."""
+    sample = "{warm}\n\n{0:0:LBL_000}\n<E001 0>text<SEC_END>"
+    for isSOJ in (False, True):
+        for isGMD in (True, False):
+            json_data = json.loads(convert_to_json(sample, isGMD=isGMD, isSOJ=isSOJ))
+            json_to_text(json_data, isGMD=isGMD, isSOJ=isSOJ)
+
+
+# Function to convert a single file
+def convert_file(input_file, output_file, to_json, isGMD=True, isSOJ=False, isTagsKeep=False):
+    """Converts a structured text file to JSON (to_json) or a JSON file back to text.
+    The input can be a path or a binary file object."""
     encoding = 'utf-8'
     buffering = 8192
-    base_name, ext = os.path.splitext(file)
-    output_file = args.output if args.output and len(args.input_files) == 1 else (
-        f"{base_name}.json" if args.json else f"{base_name}.txt"
-    )
-    # Set flags based on arguments
-    isGMD = not args.pc
-    isSOJ = args.soj
-    isTagsKeep = args.keeptags
 
-    with open(file, "r", encoding=encoding, buffering=buffering) as infile:
-        input_data = infile.read()
+    if hasattr(input_file, "read"):
+        # Binary file object (e.g. an in-memory upload), with universal newlines like open()
+        input_data = io.StringIO(input_file.read().decode(encoding), newline=None).read()
+    else:
+        with open(input_file, "r", encoding=encoding, buffering=buffering) as infile:
+            input_data = infile.read()
 
     # Perform conversion
     output_data = (
         convert_to_json(input_data, isGMD=isGMD, isSOJ=isSOJ) 
-        if args.json 
+        if to_json 
         else json_to_text(json.loads(input_data), isGMD=isGMD, isSOJ=isSOJ, isTagsKeep=isTagsKeep)
     )
 
     with open(output_file, "w", encoding=encoding, buffering=buffering) as outfile:
         outfile.write(output_data)
 
+
+# Function to process each file (for multiprocessing)
+def process_file(file, args):
+    base_name, ext = os.path.splitext(file)
+    output_file = args.output if args.output and len(args.input_files) == 1 else (
+        f"{base_name}.json" if args.json else f"{base_name}.txt"
+    )
+    # Set flags based on arguments
+    isGMD = not args.pc
+    isSOJ = args.soj
+    isTagsKeep = args.keeptags
+
+    convert_file(file, output_file, args.json, isGMD=isGMD, isSOJ=isSOJ, isTagsKeep=isTagsKeep)
+
     print(f"Processed: {file} -> {output_file}") 
 
 
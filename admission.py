@@ -0,0 +1,122 @@
+import fcntl
+import os
+import threading
+
+# Lock files of the conversion slots, shared by every worker process on this node
+ADMISSION_FOLDER = 'admission'
+
+# Largest accepted upload (bigger requests get 413)
+MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 256 * 1024 * 1024))
+
+# Jobs waiting or running per HTTP worker before new ones are refused with 429
+MAX_PENDING_JOBS = int(os.environ.get('MAX_PENDING_JOBS', 64))
+
+# Of those, jobs one client may have waiting or running, so a big batch cannot lock others out
+MAX_PENDING_PER_CLIENT = int(os.environ.get('MAX_PENDING_PER_CLIENT', max(1, MAX_PENDING_JOBS // 2)))
+
+# Seconds a refused client is asked to wait (Retry-After)
+RETRY_AFTER = int(os.environ.get('RETRY_AFTER', 5))
+
+# Proxies in front of the server that append the client's address to X-Forwarded-For
+# (1 for the platform's router, 0 when clients connect directly)
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+
+# Conversions of each converter allowed to run at the same time on this node,
+# e.g. CONVERTER_LIMIT_SOUNDS_NSW=1
+DEFAULT_LIMITS = {
+    "GMD": os.cpu_count() or 1,
+    "Script": os.cpu_count() or 1,
+    "Sounds PC": 2,
+    "Sounds NSW": 2
+}
+
+# Header-only commands: they take milliseconds whatever the input's size, so they skip the
+# converters' slots and run in the job scheduler's fast lane instead of queueing behind conversions.
+# (GMD info decodes every section and Sounds NSW info runs ffprobe on the payload, so those queue.)
+FAST_LANE_COMMANDS = {
+    "Sounds PC": {"i"}
+}
+
+
+class QueueFullError(Exception):
+    """Raised when no more conversions can be accepted right now."""
+
+
+def converter_limit(converter):
+    name = 'CONVERTER_LIMIT_' + converter.upper().replace(' ', '_')
+    return int(os.environ.get(name, DEFAULT_LIMITS[converter]))
+
+
+def is_fast(converter, command):
+    return command in FAST_LANE_COMMANDS.get(converter, ())
+
+
+def client_address(forwarded_for, remote_addr):
+    """
+    Returns the address of a client, as the first of the TRUSTED_PROXY_HOPS proxies saw it
+    (or remote_addr without proxies). The X-Forwarded-For entries left of those are
+    sent by the client itself, so they are never used.
+    """
+    addresses = [address.strip() for address in forwarded_for.split(",")] if forwarded_for else []
+    if TRUSTED_PROXY_HOPS and len(addresses) >= TRUSTED_PROXY_HOPS:
+        return addresses[-TRUSTED_PROXY_HOPS]
+    return remote_addr
+
+
+# POSIX record locks belong to the whole process (and are not inherited by forked
+# pool workers), so slots held by this process are also tracked here
+_held = set()
+_held_lock = threading.Lock()
+
+
+class Slot:
+    """
+    A held conversion slot (a lock on one of the converter's lock files).
+    The lock is dropped by the OS if the holding process dies.
+    """
+
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+
+    def release(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        with _held_lock:
+            _held.discard(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def try_acquire(converter, command=None):
+    """
+    Takes a free slot of the converter without waiting. Returns a Slot, or None if all are busy.
+    Fast lane commands get a slot that holds nothing, they are never refused.
+    """
+    if is_fast(converter, command):
+        return Slot(None, None)
+
+    os.makedirs(ADMISSION_FOLDER, exist_ok=True)
+    slug = converter.lower().replace(' ', '-')
+
+    for i in range(converter_limit(converter)):
+        path = os.path.join(ADMISSION_FOLDER, f"{slug}-{i}.lock")
+        with _held_lock:
+            if path in _held:
+                continue
+            fd = os.open(path, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            _held.add(path)
+        return Slot(path, fd)
+
+    return None
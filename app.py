@@ -1,21 +1,58 @@
+import io
 import os
-import glob
-import subprocess
-from flask import Flask, request, send_file, render_template_string
+import shutil
+import tempfile
+import time
+import zipfile
+import flask
+from flask import Flask, Response, request, send_file, render_template_string, jsonify, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator
+
+import admission
+import batch
+import cache
+import compression
+import engine
+import janitor
+import jobs
+import library
+import limits
+import metrics
+import storage
+from engine import CONVERTERS, ConversionError, ConverterUnavailableError
+
+from storage import UPLOAD_FOLDER
 
-UPLOAD_FOLDER = 'uploads'
-CONVERTER_FOLDER = 'Converter'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+
+class Request(flask.Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Keep uploaded files in memory up to the spool threshold (instead of werkzeug's 500 KB)
+        return tempfile.SpooledTemporaryFile(max_size=storage.UPLOAD_SPOOL_BYTES, mode='rb+')
+
+
 app = Flask(__name__)
+app.request_class = Request
+app.config['MAX_CONTENT_LENGTH'] = admission.MAX_CONTENT_LENGTH
 
-CONVERTERS = {
-    "GMD": "gs56-gmd-converter.py",
-    "Script": "gs56-script-converter.py",
-    "Sounds PC": "asrc31.py",
-    "Sounds NSW": "asrc31-nsw.py"
-}
+# Import and warm the converters once per worker instead of once per request
+# (once in total when gunicorn preloads the app, see gunicorn.conf.py)
+engine.load_converters()
+
+# Remove old work directories and job results in the background. Started with the first
+# request, so a preloading gunicorn master never forks while the thread holds a lock.
+app.before_request(janitor.start)
+
+# Convert on the job worker pool (with its bounds and limits) instead of in the HTTP worker,
+# e.g. when these routes run on threads of the ASGI server's process (asgi.py turns it on)
+CONVERT_ON_POOL = os.environ.get('CONVERT_ON_POOL', '0') == '1'
+
+# Index the base assets for Sounds replace (only new or changed files are parsed)
+if os.path.isdir(library.LIBRARY_FOLDER):
+    library.build_index()
 
 COMMAND_SETS = {
     "GMD": [
@@ -43,53 +80,235 @@ COMMAND_SETS = {
 }
 
 
-@app.route('/', methods=['GET', 'POST'])
-def upload_file():
-    if request.method == 'POST':
-        converter = request.form.get("converter")
-        command = request.form.get("command")
-
-        if 'file' not in request.files:
-            return "No file uploaded"
-
-        file = request.files['file']
-        if file.filename == '':
-            return "No file selected"
-
-        filename = secure_filename(file.filename)
-        input_path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(input_path)
+def validate_command(converter, command):
+    """
+    Returns an error message for an unknown converter or command, or None.
+    """
+    if converter not in CONVERTERS:
+        return "Unknown converter"
 
-        converter_script = os.path.join(CONVERTER_FOLDER, CONVERTERS[converter])
+    if command not in dict(COMMAND_SETS[converter]):
+        return "Unknown command"
 
-        # ------------------------------
-        # BUILD CORRECT COMMAND (NO OUTPUT PATH)
-        # ------------------------------
-        cmd = ['python', converter_script, command]
+    return None
 
-        # GS5 encryption requires --xor
-        if converter == "GMD" and command == "e" and filename.startswith("GS5"):
-            cmd.append("--xor")
 
-        cmd.append(input_path)
+def build_options(converter, command, filename, form):
+    """
+    Returns the converter options for a file: the extra form fields plus the GS5 --xor flag.
+    """
+    # Extra form fields (e.g. id/unk0/unk1/urate for Sounds) are passed as options
+    options = {k: v for k, v in form.items() if k not in ("converter", "command", "base_sha256")}
 
-        # ------------------------------
-        # RUN CONVERSION
-        # ------------------------------
-        result = subprocess.run(cmd, capture_output=True, text=True)
+    # "base" names an asset of the server's library (by id or library path), never a file
+    # outside it. Its hash is added, so cached results change along with the base file.
+    if options.get("base"):
+        try:
+            options["base_sha256"] = library.find(converter, options["base"])["sha256"]
+        except ConversionError:
+            pass
+
+    # GS5 encryption requires --xor
+    if converter == "GMD" and command == "e" and filename.startswith("GS5"):
+        options["xor"] = True
+
+    return options
+
+
+def read_conversion_form():
+    """
+    Reads the converter, command, uploaded file and options of a conversion form.
+    Returns (converter, command, file, filename, options), or an error message string.
+    """
+    converter = request.form.get("converter")
+    command = request.form.get("command")
+
+    if 'file' not in request.files:
+        return "No file uploaded"
+
+    file = request.files['file']
+    if file.filename == '':
+        return "No file selected"
+
+    error = validate_command(converter, command)
+    if error:
+        return error
+
+    filename = secure_filename(file.filename)
+    if not filename:
+        return "Invalid file name"
+
+    options = build_options(converter, command, filename, request.form)
+    return converter, command, file, filename, options
+
+
+def busy_response(body):
+    """
+    Returns a 429 response asking the client to retry later.
+    """
+    return body, 429, {"Retry-After": str(admission.RETRY_AFTER)}
+
+
+def client_id():
+    """
+    Returns who a request is from, for sharing the job queue fairly between clients
+    (the address the trusted proxy saw, see admission.client_address()).
+    """
+    return admission.client_address(",".join(request.headers.getlist("X-Forwarded-For")), request.remote_addr)
+
+
+def discard_workdir(workdir, lease):
+    """
+    Releases the janitor lease of a request's work directory and removes it.
+    """
+    lease.release()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def send_output(output_path, converter, command, on_close=None, download_name=None, cache_key=None):
+    """
+    Sends an output file, recording the send time and calling on_close
+    (e.g. to remove the work directory) once the response is closed.
+    Text and JSON outputs are compressed if the client accepts it. The compressed copy is
+    kept next to the cached result (of cache_key, if given) or else next to the output.
+    """
+    start = time.perf_counter()
+    download_name = download_name or os.path.basename(output_path)
+
+    path, encoding, compressible = compression.select(output_path, download_name, request.accept_encodings,
+                                                      cache.lookup(cache_key) if cache_key else None)
+
+    metrics.inc("converter_response_bytes_total", os.path.getsize(path),
+                converter=converter, command=command, encoding=encoding or "identity")
+
+    def finished():
+        if on_close:
+            on_close()
+        metrics.observe("converter_phase_seconds", time.perf_counter() - start,
+                        converter=converter, command=command, phase="send")
+        metrics.flush()
+
+    response = send_file(os.path.abspath(path), as_attachment=True, download_name=download_name)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if compressible:
+        response.vary.add("Accept-Encoding")
+    # call_on_close() is skipped for direct passthrough responses, so wrap the body instead
+    response.response = ClosingIterator(response.response, finished)
+    return response
+
+
+def convert_and_send(stream, converter, command, filename, options, endpoint):
+    """
+    Saves an upload into its own work directory, converts it (or takes the result
+    from the cache) and returns the response sending the output.
+    Raises ConversionError if the conversion fails, or admission.QueueFullError
+    if every slot of the converter is busy.
+    """
+    metrics.inc("converter_requests_total", converter=converter, command=command, endpoint=endpoint)
+
+    # Every request converts in its own directory, so same-named uploads never collide
+    workdir = tempfile.mkdtemp(dir=UPLOAD_FOLDER)
+    lease = janitor.Lease(workdir)
+    input_path = os.path.join(workdir, filename)
+
+    # Small uploads are converted straight from memory, only large ones touch the disk
+    try:
+        with metrics.timed("save", converter, command):
+            source, sha256, size = storage.spool_upload(stream, input_path)
+    except Exception:
+        # e.g. the body turned out larger than MAX_CONTENT_LENGTH
+        discard_workdir(workdir, lease)
+        raise
+    metrics.inc("converter_upload_bytes_total", size, converter=converter, command=command)
+
+    # Keep the upload, so the next conversion of the same file can skip uploading it.
+    # A spilled upload is only linked, an in-memory one is written once the response is sent
+    # (the converters may close it, so keep its bytes).
+    if not hasattr(source, 'getvalue'):
+        storage.store_blob(source, sha256)
+        return convert_stored(workdir, lease, source, sha256, converter, command, filename, options)
+
+    upload = io.BytesIO(source.getvalue())
+    try:
+        response = convert_stored(workdir, lease, source, sha256, converter, command, filename, options)
+    except Exception:
+        storage.store_blob(upload, sha256)
+        raise
+    response.response = ClosingIterator(response.response, lambda: storage.store_blob(upload, sha256))
+    return response
+
+
+def convert_stored(workdir, lease, source, sha256, converter, command, filename, options):
+    """
+    Converts an input that is already on the server (or takes the result from the cache)
+    in its leased work directory, and returns the response sending the output.
+    Raises like convert_and_send().
+    """
+    output_path = engine.build_output_path(converter, command, filename, workdir)
 
-        if result.returncode != 0:
-            return f"Conversion failed:<br><pre>{result.stderr}</pre>"
+    # ------------------------------
+    # SERVE REPEATED CONVERSIONS FROM THE RESULT CACHE
+    # ------------------------------
+    key = cache.cache_key(sha256, converter, command, options)
+    with metrics.timed("locate", converter, command):
+        cached = cache.lookup(key)
+    if cached:
+        discard_workdir(workdir, lease)
+        metrics.inc("converter_cache_hits_total", converter=converter, command=command)
+        return send_output(cached, converter, command, download_name=os.path.basename(output_path))
 
-        # ------------------------------
-        # FIND OUTPUT FILE CREATED BY CONVERTER
-        # ------------------------------
-        output_file = detect_output_file(filename)
+    # ------------------------------
+    # RUN CONVERSION (ON THE WORKER POOL, OR IN-PROCESS IN ONE OF THE CONVERTER'S SLOTS)
+    # ------------------------------
+    if CONVERT_ON_POOL:
+        try:
+            jobs.schedule(converter, command, jobs.convert_task, converter, command, source, output_path,
+                          options, client=client_id()).result()
+        except (admission.QueueFullError, ConversionError):
+            # The task records its own failure
+            discard_workdir(workdir, lease)
+            raise
+
+        with metrics.timed("locate", converter, command):
+            cache.store(key, output_path)
+        return send_output(output_path, converter, command, lambda: discard_workdir(workdir, lease), cache_key=key)
+
+    slot = admission.try_acquire(converter, command)
+    if slot is None:
+        discard_workdir(workdir, lease)
+        raise admission.QueueFullError(f"All {converter} conversion slots are busy, try again later")
+
+    try:
+        # Only the time limit applies here, a memory limit would cap the whole HTTP worker
+        with slot, metrics.timed("convert", converter, command), limits.enforced(converter, memory=False):
+            base = library.base_for(converter, command, options)
+            engine.convert(converter, command, source, output_path, options, base=base)
+    except ConversionError:
+        discard_workdir(workdir, lease)
+        metrics.inc("converter_failures_total", converter=converter, command=command)
+        metrics.flush()
+        raise
+
+    with metrics.timed("locate", converter, command):
+        cache.store(key, output_path)
+    return send_output(output_path, converter, command, lambda: discard_workdir(workdir, lease), cache_key=key)
 
-        if not output_file:
-            return "Conversion complete, but no output file was found."
 
-        return send_file(output_file, as_attachment=True)
+@app.route('/', methods=['GET', 'POST'])
+def upload_file():
+    if request.method == 'POST':
+        form = read_conversion_form()
+        if isinstance(form, str):
+            return form
+
+        converter, command, file, filename, options = form
+        try:
+            return convert_and_send(file.stream, converter, command, filename, options, "form")
+        except admission.QueueFullError as e:
+            return busy_response(str(e))
+        except ConversionError as e:
+            return f"Conversion failed:<br><pre>{e}</pre>"
 
     # ------------------------------
     # HTML UI
@@ -140,27 +359,454 @@ def upload_file():
     ''')
 
 
-def detect_output_file(filename):
-    """Detect output file produced by the converter."""
-
-    base = os.path.splitext(filename)[0]
-
-    # Possible output extensions for GMD/script
-    possible_exts = ["*.gmd", "*.txt", "*.json"]
-
-    found_files = []
-    for ext in possible_exts:
-        found_files += glob.glob(os.path.join(CONVERTER_FOLDER, base + ext))
-
-    if found_files:
-        return found_files[0]
-
-    # Sound converters output .wav or .bin
-    sound_exts = ["*.wav", "*.bin"]
-    for ext in sound_exts:
-        found_files += glob.glob(os.path.join(CONVERTER_FOLDER, base + ext))
-
-    return found_files[0] if found_files else None
+# Converter names as used in API URLs, e.g. /api/v1/convert/sounds-pc/i
+API_CONVERTERS = {name.lower().replace(' ', '-'): name for name in CONVERTERS}
+
+
+def read_api_options(converter, command, query=None):
+    """
+    Returns the file name and converter options of an API request's query parameters
+    (of this request, or the given query parameters).
+    """
+    query = request.args if query is None else query
+    filename = secure_filename(query.get("filename", "input"))
+    args = dict(query.items())
+    for name in ("filename", "converter", "command"):
+        args.pop(name, None)
+    return filename, build_options(converter, command, filename, args)
+
+
+@app.route('/api/v1/convert/<converter>/<command>', methods=['POST'])
+def api_convert(converter, command):
+    """
+    Converts the raw request body and returns the output bytes.
+    The file name goes in the "filename" query parameter, any other parameter is a converter option.
+    Errors are returned as JSON.
+    """
+    converter = API_CONVERTERS.get(converter.lower(), converter)
+    error = validate_command(converter, command)
+    if error:
+        return jsonify(error=error), 404
+
+    filename, options = read_api_options(converter, command)
+    if not filename:
+        return jsonify(error="Invalid file name"), 400
+
+    if not request.content_length and request.headers.get("Transfer-Encoding") != "chunked":
+        return jsonify(error="Empty request body"), 400
+
+    try:
+        return convert_and_send(request.stream, converter, command, filename, options, "api")
+    except admission.QueueFullError as e:
+        return busy_response(jsonify(error=str(e)))
+    except ConverterUnavailableError as e:
+        return jsonify(error=str(e)), 503
+    except ConversionError as e:
+        return jsonify(error=str(e)), 422
+
+
+@app.route('/api/v1/metadata/<converter>', methods=['POST'])
+def api_metadata(converter):
+    """
+    Returns the header fields of the raw request body (a GMD or .asrc.31 file) as JSON:
+    the GMD header, label tables and label names, or the .asrc header.
+    Only the header is read, the rest of the body is never received
+    (unless CONVERT_ON_POOL is on, see metadata_on_pool(), or asgi.py for an ASGI server).
+    """
+    converter = API_CONVERTERS.get(converter.lower(), converter)
+    if converter not in engine.METADATA_CONVERTERS:
+        return jsonify(error=f'Converter "{converter}" has no header to read'), 404
+
+    if not request.content_length and request.headers.get("Transfer-Encoding") != "chunked":
+        return jsonify(error="Empty request body"), 400
+
+    metrics.inc("converter_requests_total", converter=converter, command="i", endpoint="metadata")
+    if CONVERT_ON_POOL:
+        return metadata_on_pool(converter)
+
+    try:
+        # A header read needs no slot (like the "i" commands), only the time limit applies
+        with metrics.timed("convert", converter, "i"), limits.enforced(converter, memory=False):
+            metadata = engine.read_metadata(converter, request.stream)
+    except ConverterUnavailableError as e:
+        return jsonify(error=str(e)), 503
+    except ConversionError as e:
+        metrics.inc("converter_failures_total", converter=converter, command="i")
+        return jsonify(error=str(e)), 422
+    finally:
+        metrics.flush()
+    return jsonify(metadata)
+
+
+def metadata_on_pool(converter):
+    """
+    Like api_metadata(), but the header is parsed in the worker pool's fast lane: the body
+    is saved first (a pool worker cannot read the request). asgi.py serves this endpoint
+    itself, reading only the header.
+    """
+    workdir = tempfile.mkdtemp(dir=UPLOAD_FOLDER)
+    lease = janitor.Lease(workdir)
+    try:
+        input_path = os.path.join(workdir, "input")
+        storage.save_upload(request.stream, input_path)
+        metadata = jobs.schedule(converter, "i", jobs.metadata_task, converter, input_path,
+                                 client=client_id(), fast=True).result()
+    except admission.QueueFullError as e:
+        return busy_response(jsonify(error=str(e)))
+    except ConverterUnavailableError as e:
+        return jsonify(error=str(e)), 503
+    except ConversionError as e:
+        return jsonify(error=str(e)), 422
+    finally:
+        discard_workdir(workdir, lease)
+    return jsonify(metadata)
+
+
+@app.route('/api/v1/library')
+def library_index():
+    """
+    Lists the base assets available to Sounds replace (the "base" option takes an id or path).
+    Takes an optional "converter" filter, e.g. ?converter=sounds-nsw.
+    """
+    entries = library.get_index()
+    converter = request.args.get("converter")
+    if converter:
+        converter = API_CONVERTERS.get(converter.lower(), converter)
+        entries = [entry for entry in entries if entry["converter"] == converter]
+    return jsonify(entries)
+
+
+# ------------------------------
+# UPLOAD DEDUPLICATION BY CONTENT HASH
+# ------------------------------
+@app.route('/api/v1/check-hash/<sha256>')
+def check_hash(sha256):
+    """
+    Tells whether a file (by its sha256) is already stored on the server, and, given a
+    converter and command (plus filename and options), whether its result is cached.
+    Either way, /api/v1/convert-by-hash can then be used instead of uploading it.
+    """
+    sha256 = sha256.lower()
+    if not storage.SHA256_PATTERN.fullmatch(sha256):
+        return jsonify(error="Invalid sha256"), 400
+
+    result = {"sha256": sha256, "stored": storage.find_blob(sha256) is not None, "cached": False}
+
+    converter = request.args.get("converter")
+    command = request.args.get("command")
+    if converter or command:
+        converter = API_CONVERTERS.get((converter or "").lower(), converter)
+        error = validate_command(converter, command)
+        if error:
+            return jsonify(error=error), 404
+        filename, options = read_api_options(converter, command)
+        result["cached"] = cache.lookup(cache.cache_key(sha256, converter, command, options)) is not None
+
+    return jsonify(result)
+
+
+@app.route('/api/v1/convert-by-hash/<converter>/<command>/<sha256>', methods=['POST'])
+def api_convert_by_hash(converter, command, sha256):
+    """
+    Like /api/v1/convert, for a file the server already has (see /api/v1/check-hash),
+    so nothing is uploaded. Returns 404 if the file is not stored (upload it instead).
+    """
+    converter = API_CONVERTERS.get(converter.lower(), converter)
+    error = validate_command(converter, command)
+    if error:
+        return jsonify(error=error), 404
+
+    sha256 = sha256.lower()
+    if not storage.SHA256_PATTERN.fullmatch(sha256):
+        return jsonify(error="Invalid sha256"), 400
+
+    filename, options = read_api_options(converter, command)
+    if not filename:
+        return jsonify(error="Invalid file name"), 400
+
+    metrics.inc("converter_requests_total", converter=converter, command=command, endpoint="hash")
+
+    # A cached result does not even need the input
+    cached = cache.lookup(cache.cache_key(sha256, converter, command, options))
+    if cached:
+        metrics.inc("converter_cache_hits_total", converter=converter, command=command)
+        download_name = os.path.basename(engine.build_output_path(converter, command, filename, ""))
+        return send_output(cached, converter, command, download_name=download_name)
+
+    workdir = tempfile.mkdtemp(dir=UPLOAD_FOLDER)
+    lease = janitor.Lease(workdir)
+    input_path = os.path.join(workdir, filename)
+    if not storage.fetch_blob(sha256, input_path):
+        discard_workdir(workdir, lease)
+        metrics.flush()
+        # The path names the converter and command, so they cannot be query parameters too
+        query = {name: value for name, value in request.args.items() if name not in ("converter", "command")}
+        return jsonify(error="Unknown file, upload it instead",
+                       upload_url=url_for("api_convert", converter=converter.lower().replace(' ', '-'),
+                                          command=command, **query)), 404
+
+    try:
+        return convert_stored(workdir, lease, input_path, sha256, converter, command, filename, options)
+    except admission.QueueFullError as e:
+        return busy_response(jsonify(error=str(e)))
+    except ConverterUnavailableError as e:
+        return jsonify(error=str(e)), 503
+    except ConversionError as e:
+        return jsonify(error=str(e)), 422
+
+
+@app.route('/batch', methods=['POST'])
+def batch_convert():
+    """
+    Converts a zip archive (or several "file" fields) in parallel.
+    Streams back a zip of the results with a manifest.json of every entry's outcome.
+    """
+    converter = request.form.get("converter")
+    command = request.form.get("command")
+
+    error = validate_command(converter, command)
+    if error:
+        return jsonify(error=error), 400
+
+    files = [file for file in request.files.getlist('file') if file.filename]
+    if not files:
+        return jsonify(error="No file uploaded"), 400
+
+    if not jobs.has_capacity(client=client_id()):
+        return busy_response(jsonify(error="Too many conversions are pending, try again later"))
+
+    workdir = tempfile.mkdtemp(dir=UPLOAD_FOLDER)
+    lease = janitor.Lease(workdir)
+    try:
+        entries = batch.collect_entries(files, workdir)
+    except zipfile.BadZipFile:
+        discard_workdir(workdir, lease)
+        return jsonify(error="Invalid zip archive"), 400
+    except batch.BatchTooLargeError as e:
+        discard_workdir(workdir, lease)
+        return jsonify(error=str(e)), 413
+
+    form = request.form.to_dict()
+    options_for = lambda name: build_options(converter, command, os.path.basename(name), form)
+
+    return Response(batch.stream_results(entries, converter, command, options_for, workdir, lease, client_id()),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=converted.zip'})
+
+
+def queue_job(job_id, directory, converter, command, filename, options, sha256):
+    """
+    Queues the conversion of a job whose input file is already in its directory,
+    and returns the 202 response with the job's status and URLs.
+    """
+    key = cache.cache_key(sha256, converter, command, options)
+    try:
+        status = jobs.submit(job_id, converter, command, filename, options, cache_key=key, client=client_id())
+    except admission.QueueFullError as e:
+        shutil.rmtree(directory, ignore_errors=True)
+        metrics.flush()
+        return busy_response(jsonify(error=str(e)))
+    if status.get("cached"):
+        metrics.inc("converter_cache_hits_total", converter=converter, command=command)
+    metrics.flush()
+    status["status_url"] = url_for("job_status", job_id=job_id)
+    status["events_url"] = url_for("job_events", job_id=job_id)
+    status["result_url"] = url_for("job_result", job_id=job_id)
+    return jsonify(status), 202
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queues a conversion and returns its job id right away."""
+    form = read_conversion_form()
+    if isinstance(form, str):
+        return jsonify(error=form), 400
+
+    converter, command, file, filename, options = form
+    if not jobs.has_capacity(client=client_id()):
+        return busy_response(jsonify(error="Too many conversions are pending, try again later"))
+
+    metrics.inc("converter_requests_total", converter=converter, command=command, endpoint="jobs")
+    job_id, directory = jobs.create_job()
+    input_path = os.path.join(directory, filename)
+    with metrics.timed("save", converter, command):
+        sha256 = storage.save_upload(file.stream, input_path)
+    metrics.inc("converter_upload_bytes_total", os.path.getsize(input_path), converter=converter, command=command)
+    storage.store_blob(input_path, sha256)
+
+    return queue_job(job_id, directory, converter, command, filename, options, sha256)
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = jobs.get_status(job_id)
+    if not status:
+        return jsonify(error="Unknown job"), 404
+    return jsonify(status)
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancels a queued or running job. Its partial output is removed."""
+    status = jobs.cancel(job_id)
+    if not status:
+        return jsonify(error="Unknown job"), 404
+    if status.get("state") not in ("queued", "running", "cancelled"):
+        # Already finished
+        return jsonify(status), 409
+    return jsonify(status), 202
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    Streams the job's state and percent complete as server-sent events.
+    The stream ends when the job finishes, or after a short while (clients then reconnect).
+    """
+    if not jobs.get_status(job_id):
+        return jsonify(error="Unknown job"), 404
+
+    return Response(jobs.status_events(job_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    status = jobs.get_status(job_id)
+    if not status:
+        return jsonify(error="Unknown job"), 404
+
+    output_file = jobs.get_result_path(job_id)
+    if not output_file:
+        # Not finished yet (or failed): report the state instead
+        return jsonify(status), 409
+
+    return send_output(output_file, status["converter"], status["command"])
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    message = f"The upload is larger than the limit of {admission.MAX_CONTENT_LENGTH} bytes"
+    if request.path == '/':
+        return message, 413
+    return jsonify(error=message), 413
+
+
+# ------------------------------
+# RESUMABLE UPLOADS
+# ------------------------------
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """
+    Starts a resumable upload. Takes the "filename" (and optionally the total "size")
+    as form fields, query parameters or JSON.
+    """
+    fields = request.get_json(silent=True) or request.values
+    filename = secure_filename(fields.get("filename", ""))
+    if not filename:
+        return jsonify(error="Invalid file name"), 400
+
+    size = fields.get("size")
+    if size is not None:
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            return jsonify(error="Invalid size"), 400
+        if size < 0:
+            return jsonify(error="Invalid size"), 400
+        if size > admission.MAX_CONTENT_LENGTH:
+            raise RequestEntityTooLarge()
+
+    upload_id = storage.create_staged_upload(filename, size)
+    upload_url = url_for("upload_status", upload_id=upload_id)
+    return jsonify(id=upload_id, filename=filename, size=size, offset=0, upload_url=upload_url,
+                   commit_url=url_for("commit_upload", upload_id=upload_id)), 201, \
+        {"Location": upload_url, "Upload-Offset": "0"}
+
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'HEAD'])
+def upload_status(upload_id):
+    """Returns how much of an upload has arrived (also as the Upload-Offset header)."""
+    upload = storage.get_staged_upload(upload_id)
+    if not upload:
+        return jsonify(error="Unknown upload"), 404
+    return jsonify(upload), {"Upload-Offset": str(upload["offset"]), "Cache-Control": "no-store"}
+
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """
+    Appends the raw request body at the offset given in the Upload-Offset header.
+    A mismatched offset gets 409 with the current offset, so the client can resume from there.
+    """
+    if not storage.get_staged_upload(upload_id):
+        return jsonify(error="Unknown upload"), 404
+
+    try:
+        offset = int(request.headers["Upload-Offset"])
+    except (KeyError, ValueError):
+        return jsonify(error="Missing or invalid Upload-Offset header"), 400
+
+    # The upload lock keeps concurrent chunks of the same upload (from any thread or process) in order
+    try:
+        with janitor.Lease(storage.staging_dir(upload_id)), storage.UploadLock(upload_id):
+            offset = storage.append_chunk(upload_id, offset, request.stream, admission.MAX_CONTENT_LENGTH)
+    except FileNotFoundError:
+        # Committed (or removed) in the meantime
+        return jsonify(error="Unknown upload"), 404
+    except storage.UploadOffsetError as e:
+        return jsonify(error=str(e), offset=e.offset), 409, {"Upload-Offset": str(e.offset)}
+    except storage.StagedUploadError as e:
+        return jsonify(error=str(e)), 413
+
+    return "", 204, {"Upload-Offset": str(offset)}
+
+
+@app.route('/uploads/<upload_id>/commit', methods=['POST'])
+def commit_upload(upload_id):
+    """
+    Queues the conversion of a completed upload (like /jobs, with the converter, command
+    and options as form fields). The staged file becomes the job's input without a copy.
+    """
+    upload = storage.get_staged_upload(upload_id)
+    if not upload:
+        return jsonify(error="Unknown upload"), 404
+
+    if upload["size"] is not None and upload["offset"] != upload["size"]:
+        return jsonify(error="The upload is incomplete", offset=upload["offset"]), 409, \
+            {"Upload-Offset": str(upload["offset"])}
+
+    converter = request.form.get("converter")
+    command = request.form.get("command")
+    error = validate_command(converter, command)
+    if error:
+        return jsonify(error=error), 400
+
+    if not jobs.has_capacity(client=client_id()):
+        return busy_response(jsonify(error="Too many conversions are pending, try again later"))
+
+    filename = upload["filename"]
+    options = build_options(converter, command, filename, request.form)
+
+    metrics.inc("converter_requests_total", converter=converter, command=command, endpoint="uploads")
+    job_id, directory = jobs.create_job()
+    try:
+        with janitor.Lease(storage.staging_dir(upload_id)), storage.UploadLock(upload_id):
+            sha256, size = storage.take_staged_upload(upload_id, os.path.join(directory, filename))
+    except FileNotFoundError:
+        # Committed by another request in the meantime
+        shutil.rmtree(directory, ignore_errors=True)
+        return jsonify(error="Unknown upload"), 404
+    metrics.inc("converter_upload_bytes_total", size, converter=converter, command=command)
+    storage.store_blob(os.path.join(directory, filename), sha256)
+
+    return queue_job(job_id, directory, converter, command, filename, options, sha256)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics of all HTTP and conversion worker processes."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
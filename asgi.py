@@ -0,0 +1,335 @@
+# Asynchronous front end for nodes that hold many slow uploads and downloads open at once:
+#
+#     uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers 2
+#
+# Raw-body conversions, header reads, resumable upload chunks, job event streams and job results
+# are served here with non-blocking I/O, and their conversions run on the job worker pool
+# (bounded like every other job, so a node converts only as much as it has slots and workers for).
+# Every other route is the Flask app (app.py), run on a small thread pool. Its conversions
+# run on the job worker pool as well (app.CONVERT_ON_POOL), never on those threads.
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_accept_header
+
+import admission
+import app as flask_app
+import cache
+import compression
+import engine
+import janitor
+import jobs
+import metrics
+import storage
+from engine import ConversionError, ConverterUnavailableError
+
+# Threads running requests of the Flask routes
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 16))
+
+# The Flask routes share this process with the event loop, so they convert on the pool too
+flask_app.CONVERT_ON_POOL = True
+
+
+def client_id(request):
+    # Like app.client_id(): the address the trusted proxy saw
+    return admission.client_address(",".join(request.headers.getlist("x-forwarded-for")),
+                                    request.client.host if request.client else None)
+
+
+def busy_response(error):
+    return JSONResponse({"error": str(error)}, 429, headers={"Retry-After": str(admission.RETRY_AFTER)})
+
+
+def has_body(request):
+    return (request.headers.get("content-length", "0") != "0"
+            or request.headers.get("transfer-encoding") == "chunked")
+
+
+async def save_body(request, path):
+    """
+    Writes the request body to path as it arrives and returns (sha256, size).
+    Raises RequestEntityTooLarge above admission.MAX_CONTENT_LENGTH.
+    """
+    if int(request.headers.get("content-length") or 0) > admission.MAX_CONTENT_LENGTH:
+        raise RequestEntityTooLarge()
+
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as out:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > admission.MAX_CONTENT_LENGTH:
+                raise RequestEntityTooLarge()
+            sha256.update(chunk)
+            out.write(chunk)
+    return sha256.hexdigest(), size
+
+
+async def send_output(request, output_path, converter, command, on_close=None, download_name=None, cache_key=None):
+    """
+    Like app.send_output(): sends an output file (compressed if the client accepts it),
+    recording the send time and calling on_close once it is sent.
+    """
+    start = time.perf_counter()
+    download_name = download_name or os.path.basename(output_path)
+    accept_encodings = parse_accept_header(request.headers.get("accept-encoding"))
+
+    # Compressing a large output takes a while, so not on the event loop
+    path, encoding, compressible = await run_in_threadpool(
+        compression.select, output_path, download_name, accept_encodings,
+        cache.lookup(cache_key) if cache_key else None)
+
+    metrics.inc("converter_response_bytes_total", os.path.getsize(path),
+                converter=converter, command=command, encoding=encoding or "identity")
+
+    def finished():
+        if on_close:
+            on_close()
+        metrics.observe("converter_phase_seconds", time.perf_counter() - start,
+                        converter=converter, command=command, phase="send")
+        metrics.flush()
+
+    headers = {}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    if compressible:
+        headers["Vary"] = "Accept-Encoding"
+    return FileResponse(path, filename=download_name, headers=headers, background=BackgroundTask(finished))
+
+
+async def api_convert(request):
+    """
+    Like /api/v1/convert in app.py, but the upload is received and the output sent without
+    blocking, and the conversion runs on the job worker pool.
+    """
+    converter = request.path_params["converter"]
+    converter = flask_app.API_CONVERTERS.get(converter.lower(), converter)
+    command = request.path_params["command"]
+    error = flask_app.validate_command(converter, command)
+    if error:
+        return JSONResponse({"error": error}, 404)
+
+    filename, options = flask_app.read_api_options(converter, command, request.query_params)
+    if not filename:
+        return JSONResponse({"error": "Invalid file name"}, 400)
+
+    if not has_body(request):
+        return JSONResponse({"error": "Empty request body"}, 400)
+
+    metrics.inc("converter_requests_total", converter=converter, command=command, endpoint="api")
+
+    workdir = tempfile.mkdtemp(dir=storage.UPLOAD_FOLDER)
+    lease = janitor.Lease(workdir)
+    input_path = os.path.join(workdir, filename)
+    try:
+        with metrics.timed("save", converter, command):
+            sha256, size = await save_body(request, input_path)
+    except RequestEntityTooLarge:
+        flask_app.discard_workdir(workdir, lease)
+        return JSONResponse({"error": f"The upload is larger than {admission.MAX_CONTENT_LENGTH} bytes"}, 413)
+    except BaseException:
+        # e.g. the client went away
+        flask_app.discard_workdir(workdir, lease)
+        raise
+    metrics.inc("converter_upload_bytes_total", size, converter=converter, command=command)
+    await run_in_threadpool(storage.store_blob, input_path, sha256)
+
+    output_path = engine.build_output_path(converter, command, filename, workdir)
+    key = cache.cache_key(sha256, converter, command, options)
+    with metrics.timed("locate", converter, command):
+        cached = cache.lookup(key)
+    if cached:
+        flask_app.discard_workdir(workdir, lease)
+        metrics.inc("converter_cache_hits_total", converter=converter, command=command)
+        return await send_output(request, cached, converter, command, download_name=os.path.basename(output_path))
+
+    try:
+        future = jobs.schedule(converter, command, jobs.convert_task, converter, command, input_path,
+                               output_path, options, client=client_id(request))
+        await asyncio.wrap_future(future)
+    except admission.QueueFullError as e:
+        flask_app.discard_workdir(workdir, lease)
+        return busy_response(e)
+    except ConverterUnavailableError as e:
+        flask_app.discard_workdir(workdir, lease)
+        return JSONResponse({"error": str(e)}, 503)
+    except ConversionError as e:
+        flask_app.discard_workdir(workdir, lease)
+        return JSONResponse({"error": str(e)}, 422)
+    except BaseException:
+        flask_app.discard_workdir(workdir, lease)
+        raise
+
+    with metrics.timed("locate", converter, command):
+        # May have to scan the cache to evict, so not on the event loop
+        await run_in_threadpool(cache.store, key, output_path)
+    return await send_output(request, output_path, converter, command,
+                             lambda: flask_app.discard_workdir(workdir, lease), cache_key=key)
+
+
+class _BodyReader:
+    """
+    A blocking view of a request body for a thread of the thread pool: read() waits for
+    the event loop to receive the next chunk, so only as much as is read is ever received.
+    Raises RequestEntityTooLarge above admission.MAX_CONTENT_LENGTH.
+    """
+
+    def __init__(self, request, loop):
+        self.chunks = request.stream()
+        self.loop = loop
+        self.buffer = b""
+        self.size = 0
+
+    async def _receive(self):
+        try:
+            return await self.chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+    def read(self, size):
+        while not self.buffer:
+            chunk = asyncio.run_coroutine_threadsafe(self._receive(), self.loop).result()
+            if not chunk:
+                return b""
+            self.size += len(chunk)
+            if self.size > admission.MAX_CONTENT_LENGTH:
+                raise RequestEntityTooLarge()
+            self.buffer = chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+async def api_metadata(request):
+    """
+    Like /api/v1/metadata in app.py: the header is parsed (on the thread pool) while the body
+    arrives, and the rest of the body is never received.
+    """
+    converter = request.path_params["converter"]
+    converter = flask_app.API_CONVERTERS.get(converter.lower(), converter)
+    if converter not in engine.METADATA_CONVERTERS:
+        return JSONResponse({"error": f'Converter "{converter}" has no header to read'}, 404)
+
+    if not has_body(request):
+        return JSONResponse({"error": "Empty request body"}, 400)
+
+    metrics.inc("converter_requests_total", converter=converter, command="i", endpoint="metadata")
+    reader = _BodyReader(request, asyncio.get_running_loop())
+    try:
+        with metrics.timed("convert", converter, "i"):
+            metadata = await run_in_threadpool(engine.read_metadata, converter, reader)
+    except RequestEntityTooLarge:
+        return JSONResponse({"error": f"The upload is larger than {admission.MAX_CONTENT_LENGTH} bytes"}, 413)
+    except ConverterUnavailableError as e:
+        return JSONResponse({"error": str(e)}, 503)
+    except ConversionError as e:
+        metrics.inc("converter_failures_total", converter=converter, command="i")
+        return JSONResponse({"error": str(e)}, 422)
+    finally:
+        metrics.flush()
+    return JSONResponse(metadata)
+
+
+async def upload_chunk(request):
+    """
+    Like PATCH /uploads/<upload_id> in app.py, receiving the chunk without blocking.
+    """
+    upload_id = request.path_params["upload_id"]
+    if not storage.get_staged_upload(upload_id):
+        return JSONResponse({"error": "Unknown upload"}, 404)
+
+    try:
+        offset = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        return JSONResponse({"error": "Missing or invalid Upload-Offset header"}, 400)
+
+    lease = None
+    upload_lock = storage.UploadLock(upload_id)
+    try:
+        lease = await run_in_threadpool(janitor.Lease, storage.staging_dir(upload_id))
+        # Waits (off the event loop) while another chunk of the same upload is being written
+        await run_in_threadpool(upload_lock.acquire)
+        path, limit = storage.check_chunk(upload_id, offset, admission.MAX_CONTENT_LENGTH)
+        start = offset
+        with open(path, 'ab') as out:
+            async for chunk in request.stream():
+                offset = storage.write_chunk(out, chunk, offset, start, limit)
+    except FileNotFoundError:
+        # Committed (or removed) in the meantime
+        return JSONResponse({"error": "Unknown upload"}, 404)
+    except storage.UploadOffsetError as e:
+        return JSONResponse({"error": str(e), "offset": e.offset}, 409, headers={"Upload-Offset": str(e.offset)})
+    except storage.StagedUploadError as e:
+        return JSONResponse({"error": str(e)}, 413)
+    except ClientDisconnect:
+        # What arrived is kept, the client resumes from the offset it gets from HEAD
+        return Response(status_code=400)
+    finally:
+        upload_lock.release()
+        if lease:
+            lease.release()
+
+    return Response(status_code=204, headers={"Upload-Offset": str(offset)})
+
+
+async def job_events(request):
+    """
+    Like /jobs/<job_id>/events in app.py, waiting between status checks without holding a thread.
+    """
+    job_id = request.path_params["job_id"]
+    if not jobs.get_status(job_id):
+        return JSONResponse({"error": "Unknown job"}, 404)
+
+    async def events():
+        for event in jobs.status_event_stream(job_id):
+            if event is None:
+                await asyncio.sleep(jobs.EVENTS_POLL_INTERVAL)
+            else:
+                yield event
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def job_result(request):
+    """
+    Like /jobs/<job_id>/result in app.py.
+    """
+    job_id = request.path_params["job_id"]
+    status = jobs.get_status(job_id)
+    if not status:
+        return JSONResponse({"error": "Unknown job"}, 404)
+
+    output_file = jobs.get_result_path(job_id)
+    if not output_file:
+        # Not finished yet (or failed): report the state instead
+        return JSONResponse(status, 409)
+
+    return await send_output(request, output_file, status["converter"], status["command"])
+
+
+@asynccontextmanager
+async def lifespan(app):
+    janitor.start()
+    yield
+
+
+app = Starlette(routes=[
+    Route('/api/v1/convert/{converter}/{command}', api_convert, methods=['POST']),
+    Route('/api/v1/metadata/{converter}', api_metadata, methods=['POST']),
+    Route('/uploads/{upload_id}', upload_chunk, methods=['PATCH']),
+    Route('/jobs/{job_id}/events', job_events),
+    Route('/jobs/{job_id}/result', job_result),
+    Mount('/', app=WSGIMiddleware(flask_app.app, workers=WSGI_THREADS)),
+], lifespan=lifespan)
@@ -0,0 +1,195 @@
+import io
+import json
+import os
+import posixpath
+import shutil
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+
+from werkzeug.utils import secure_filename
+
+import admission
+import cache
+import engine
+import jobs
+import metrics
+import storage
+
+MANIFEST_NAME = 'manifest.json'
+
+# Files one batch may hold (archive members included)
+MAX_BATCH_ENTRIES = int(os.environ.get('MAX_BATCH_ENTRIES', 1000))
+
+# Total size of a batch's files once extracted (a small zip can expand to far more than its upload)
+MAX_BATCH_BYTES = int(os.environ.get('MAX_BATCH_BYTES', 1024 * 1024 * 1024))
+
+
+class BatchTooLargeError(Exception):
+    """Raised when a batch has too many files or expands to too many bytes."""
+
+
+class ZipStream(io.RawIOBase):
+    """
+    Write-only buffer for zipfile, drained by the response generator after every entry.
+    (Not seekable, so zipfile writes data descriptors instead of seeking back.)
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def safe_entry_name(name):
+    """
+    Sanitizes every component of an archive path (no absolute paths or "..").
+    """
+    parts = [secure_filename(part) for part in name.replace('\\', '/').split('/')]
+    return '/'.join(part for part in parts if part)
+
+
+def collect_entries(files, workdir):
+    """
+    Saves the uploaded files (expanding .zip archives) into their own directories of the workdir.
+    Returns a list of entries with the sanitized name, saved path and sha256 of each file.
+    Raises zipfile.BadZipFile for an invalid archive, and BatchTooLargeError (before anything
+    is extracted) if the batch is over MAX_BATCH_ENTRIES or MAX_BATCH_BYTES.
+    """
+    # Check the sizes the archives declare first (members never extract to more than that)
+    count = 0
+    total = 0
+    for file in files:
+        if file.filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                members = [info for info in archive.infolist() if not info.is_dir()]
+            count += len(members)
+            total += sum(info.file_size for info in members)
+        else:
+            count += 1
+            file.stream.seek(0, 2)
+            total += file.stream.tell()
+            file.stream.seek(0)
+
+    if count > MAX_BATCH_ENTRIES:
+        raise BatchTooLargeError(f"The batch has {count} files, the limit is {MAX_BATCH_ENTRIES}")
+    if total > MAX_BATCH_BYTES:
+        raise BatchTooLargeError(f"The batch expands to {total} bytes, the limit is {MAX_BATCH_BYTES}")
+
+    entries = []
+
+    def add(name, stream):
+        name = safe_entry_name(name)
+        if not name:
+            return
+        directory = os.path.join(workdir, str(len(entries)))
+        os.makedirs(directory)
+        path = os.path.join(directory, posixpath.basename(name))
+        sha256 = storage.save_upload(stream, path)
+        storage.store_blob(path, sha256)
+        entries.append({"name": name, "path": path, "sha256": sha256})
+
+    for file in files:
+        if file.filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        with archive.open(info) as member:
+                            add(info.filename, member)
+        else:
+            add(file.filename, file.stream)
+
+    return entries
+
+
+def stream_results(entries, converter, command, options_for, workdir, lease=None, client=None):
+    """
+    Converts the entries on the worker pool and yields a zip archive of the results,
+    adding each one as soon as it finishes. Entries are queued only as fast as the
+    pending-job limits allow (the client's entries take turns with other clients' jobs). The archive ends with a manifest of every
+    entry's outcome. The workdir (and its janitor lease) is released afterwards.
+    """
+    buffer = ZipStream()
+    manifest = []
+    futures = {}
+    used_names = set()
+
+    def add_result(archive, entry, output_path, cached=False):
+        arcname = posixpath.join(posixpath.dirname(entry["name"]), os.path.basename(output_path))
+        if arcname in used_names:
+            arcname = f"{len(manifest)}-{arcname}"
+        used_names.add(arcname)
+
+        archive.write(output_path, arcname)
+        manifest.append({"name": entry["name"], "status": "done", "output": arcname, "cached": cached})
+
+    def finish(archive, future):
+        entry = futures.pop(future)
+        try:
+            future.result()
+        except Exception as e:
+            manifest.append({"name": entry["name"], "status": "failed", "error": str(e)})
+        else:
+            cache.store(entry["cache_key"], entry["output_path"])
+            add_result(archive, entry, entry["output_path"])
+
+    try:
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for entry in entries:
+                options = options_for(entry["name"])
+                directory, filename = os.path.split(entry["path"])
+                output_path = engine.build_output_path(converter, command, filename, directory)
+                entry["output_path"] = output_path
+                entry["cache_key"] = cache.cache_key(entry["sha256"], converter, command, options)
+
+                metrics.inc("converter_requests_total", converter=converter, command=command, endpoint="batch")
+                metrics.inc("converter_upload_bytes_total", os.path.getsize(entry["path"]), converter=converter, command=command)
+
+                if cache.fetch(entry["cache_key"], output_path):
+                    metrics.inc("converter_cache_hits_total", converter=converter, command=command)
+                    add_result(archive, entry, output_path, cached=True)
+                    yield buffer.pop()
+                    continue
+
+                while True:
+                    try:
+                        future = jobs.schedule(converter, command, jobs.convert_task, converter, command,
+                                               entry["path"], output_path, options, client=client)
+                        break
+                    except admission.QueueFullError:
+                        # The queue is full: send back finished entries until there is room again
+                        done, _ = wait(futures, timeout=admission.RETRY_AFTER, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            finish(archive, future)
+                            yield buffer.pop()
+                futures[future] = entry
+
+            for future in as_completed(list(futures)):
+                finish(archive, future)
+                yield buffer.pop()
+
+            archive.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+        yield buffer.pop()
+    finally:
+        # The client may have gone away, so drop whatever is still queued
+        for future in list(futures):
+            future.cancel()
+        if lease:
+            lease.release()
+        shutil.rmtree(workdir, ignore_errors=True)
+        metrics.flush()
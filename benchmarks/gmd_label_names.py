@@ -0,0 +1,77 @@
+# Times reading the label names of a GMD file: one read split on NUL (read_gmd_header)
+# against the byte-at-a-time loop it replaced.
+#
+#     python benchmarks/gmd_label_names.py [--labels 20000] [--repeat 5]
+import argparse
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import engine
+
+
+def byte_loop(file, label_offsets, label_count, encoding='utf-8'):
+    # The previous label name loop of read_gmd_header()
+    label_names = []
+    for i in range(label_count):
+        if label_offsets[2 * i + 1] == 0x0:
+            label_names.append("NO_LABEL")
+        else:
+            label = b""
+            while True:
+                char = file.read(1)
+                if char == b'\x00':
+                    break
+                if not char:
+                    raise ValueError("Unexpected end of file while reading label names")
+                label += char
+            label_names.append(label.decode(encoding))
+    return label_names
+
+
+def single_read(module, file, label_offsets, label_count, label_size, encoding='utf-8'):
+    # What read_gmd_header() does now (label_size is exact here)
+    return module.split_label_names(file.read(label_size), label_offsets, label_count, encoding)[0]
+
+
+def sample(label_count):
+    # V1 label table: every 10th label has no name
+    label_offsets = []
+    block = b""
+    for i in range(label_count):
+        label_offsets += [i, 0 if i % 10 == 0 else 1 + len(block)]
+        if i % 10:
+            block += f"pl{i:06d}_talk_{i % 97:02d}".encode() + b'\x00'
+    return label_offsets, block
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GMD label name reading.")
+    parser.add_argument('--labels', type=int, default=20000, help="labels in the sample table")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of each variant (the best is shown)")
+    args = parser.parse_args()
+
+    module = engine.load_converter("GMD")
+    label_offsets, block = sample(args.labels)
+
+    expected = byte_loop(io.BytesIO(block), label_offsets, args.labels)
+    if single_read(module, io.BytesIO(block), label_offsets, args.labels, len(block)) != expected:
+        sys.exit("Label names differ between the two variants")
+
+    print(f"{args.labels} labels, {len(block)} bytes of names")
+    variants = {
+        "byte loop": lambda: byte_loop(io.BytesIO(block), label_offsets, args.labels),
+        "single read": lambda: single_read(module, io.BytesIO(block), label_offsets, args.labels, len(block))
+    }
+    best = {}
+    for name, run in variants.items():
+        best[name] = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        print(f"{name:<12}{best[name] * 1000:>10.2f} ms")
+    print(f"speedup     {best['byte loop'] / best['single read']:>10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+CACHE_FOLDER = 'cache'
+
+# Size budget of the result cache, the least recently used results are evicted above it
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# Size of the cache as this process last saw it (set by evict(), grown by store()).
+# Results stored by other processes are counted at the next eviction (the janitor runs one regularly).
+_estimated_bytes = None
+_estimated_lock = threading.Lock()
+
+
+def _reset_estimated_lock():
+    # A pool worker forked while another thread held the lock would wait for it forever
+    global _estimated_lock
+    _estimated_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_estimated_lock)
+
+
+def cache_key(sha256, converter, command, options=None):
+    """
+    Returns the cache key of a conversion: the input hash plus everything that changes the output.
+    """
+    key = json.dumps([sha256, converter, command, options or {}], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _entry_path(key):
+    return os.path.join(CACHE_FOLDER, key[:2], key)
+
+
+def lookup(key):
+    """
+    Returns the path of a cached result (marking it as recently used), or None.
+    """
+    path = _entry_path(key)
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def fetch(key, output_path):
+    """
+    Places a cached result at the output path. Returns False on a cache miss.
+    """
+    path = lookup(key)
+    if not path:
+        return False
+
+    try:
+        _link_or_copy(path, output_path)
+    except OSError:
+        # Evicted in the meantime
+        return False
+    return True
+
+
+def store(key, output_path):
+    """
+    Adds a conversion result to the cache. Old results are evicted once the estimated
+    size of the cache goes over budget (only then is the cache folder scanned).
+    """
+    global _estimated_bytes
+    path = _entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Link (or copy) next to the entry first, so readers never see a partial file
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        _link_or_copy(output_path, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not cache result: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+
+    with _estimated_lock:
+        if _estimated_bytes is not None:
+            _estimated_bytes += os.path.getsize(path)
+        over_budget = _estimated_bytes is None or _estimated_bytes > CACHE_MAX_BYTES
+    if over_budget:
+        evict()
+
+
+def evict(max_bytes=None, folder=CACHE_FOLDER):
+    """
+    Removes the least recently used results until the cache fits in its budget.
+    (Also used for other content-addressed folders, such as the blob store.)
+    Returns the number of bytes freed.
+    """
+    global _estimated_bytes
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    entries = []
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+            total += st.st_size
+
+    freed = 0
+    entries.sort()
+    for _, size, path in entries:
+        if total - freed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        freed += size
+
+    if folder == CACHE_FOLDER:
+        with _estimated_lock:
+            _estimated_bytes = total - freed
+    return freed
@@ -0,0 +1,108 @@
+import gzip
+import mimetypes
+import os
+import shutil
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    # Optional: without it only gzip is offered
+    zstandard = None
+
+# Outputs of these types are compressed when the client accepts it (audio and binary files never are)
+COMPRESSIBLE_TYPES = ("text/", "application/json")
+
+# Smaller outputs are sent as they are, compressing them saves next to nothing
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Content encodings in order of preference -> suffix of their compressed copies
+ENCODINGS = {
+    "zstd": ".zst",
+    "gzip": ".gz"
+}
+
+
+def available_encodings():
+    return [encoding for encoding in ENCODINGS if encoding != "zstd" or zstandard is not None]
+
+
+def is_compressible(filename):
+    """
+    Returns whether an output (by its file name) is worth compressing.
+    """
+    mimetype = mimetypes.guess_type(filename)[0] or ""
+    return mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def negotiate(accept_encodings):
+    """
+    Returns the best content encoding the client accepts (werkzeug's request.accept_encodings),
+    or None to send the output as it is.
+    """
+    best = None
+    best_quality = 0
+    for encoding in available_encodings():
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _compress(src, dst, encoding):
+    with open(src, 'rb') as infile, open(dst, 'wb') as outfile:
+        if encoding == "zstd":
+            with zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(outfile, closefd=False) as writer:
+                shutil.copyfileobj(infile, writer)
+        else:
+            # mtime=0 keeps the copies of equal outputs byte-identical
+            with gzip.GzipFile(fileobj=outfile, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as writer:
+                shutil.copyfileobj(infile, writer)
+
+
+def compressed_copy(path, encoding):
+    """
+    Returns the path of a compressed copy of a file, kept next to it (so a cached result's copy
+    is cached as well) and created on first use. Returns None if the file is too small.
+    """
+    if os.path.getsize(path) < COMPRESSION_MIN_BYTES:
+        return None
+
+    copy_path = path + ENCODINGS[encoding]
+    try:
+        # Mark it as recently used, like the result it belongs to
+        os.utime(copy_path)
+        return copy_path
+    except OSError:
+        pass
+
+    tmp_path = f"{copy_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        _compress(path, tmp_path, encoding)
+        os.replace(tmp_path, copy_path)
+    except OSError as e:
+        print(f"Could not compress output: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    return copy_path
+
+
+def select(path, filename, accept_encodings, source=None):
+    """
+    Chooses how to send an output file named filename: returns (path to send, content encoding
+    or None, whether the response varies by Accept-Encoding). The compressed copy is made from
+    source (e.g. the cached result) if given, else from path.
+    """
+    if not is_compressible(filename):
+        return path, None, False
+
+    encoding = negotiate(accept_encodings)
+    if encoding:
+        copy_path = compressed_copy(source or path, encoding)
+        if copy_path:
+            return copy_path, encoding, True
+    return path, None, True
@@ -0,0 +1,363 @@
+import argparse
+import copy
+import importlib.util
+import os
+import shutil
+import sys
+import time
+
+
+CONVERTER_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Converter')
+
+CONVERTERS = {
+    "GMD": "gs56-gmd-converter.py",
+    "Script": "gs56-script-converter.py",
+    "Sounds PC": "asrc31.py",
+    "Sounds NSW": "asrc31-nsw.py"
+}
+
+# Output file suffix (appended to the input's base name) per converter and command
+OUTPUT_SUFFIXES = {
+    "GMD": {"i": "-raw.txt", "d": ".txt", "e": ".gmd"},
+    "Script": {"i": ".json", "d": ".json", "e": ".txt"},
+    "Sounds PC": {"i": "-info.txt", "d": ".wav", "e": ".asrc.31", "r": ".asrc.31"},
+    "Sounds NSW": {"i": "-info.txt", "d": ".ogg", "e": ".asrc.31", "r": ".asrc.31"}
+}
+
+# Converters whose file header can be read on its own (see read_metadata)
+METADATA_CONVERTERS = ("GMD", "Sounds PC", "Sounds NSW")
+
+_modules = {}
+
+
+class ConversionError(Exception):
+    """Raised when a converter fails or produces no output file."""
+
+
+class ConverterUnavailableError(ConversionError):
+    """Raised when a converter cannot be loaded on this server (e.g. missing dependency)."""
+
+
+def load_converter(converter):
+    """
+    Imports a converter script as a module (once per process) and returns it.
+    """
+    if converter in _modules:
+        return _modules[converter]
+
+    if converter not in CONVERTERS:
+        raise ConversionError(f'Unknown converter "{converter}"')
+
+    script = CONVERTERS[converter]
+    module_name = os.path.splitext(script)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(CONVERTER_FOLDER, script))
+    module = importlib.util.module_from_spec(spec)
+
+    try:
+        spec.loader.exec_module(module)
+    except SystemExit:
+        # asrc31-nsw.py exits when ffmpeg-python is missing
+        raise ConverterUnavailableError(f'Converter "{converter}" is not available on this server')
+
+    sys.modules[module_name] = module
+    _modules[converter] = module
+    return module
+
+
+def warm_converter(converter):
+    """
+    Imports a converter and runs its warm() hook, if it has one (compiling the patterns
+    and building the tables its conversions would otherwise create on first use).
+    """
+    module = load_converter(converter)
+    if hasattr(module, 'warm'):
+        module.warm()
+    return module
+
+
+def load_converters():
+    """
+    Imports and warms every converter up front, so the worker is warm before the first request
+    (or, when gunicorn preloads the app, so every worker shares them with the master).
+    """
+    for converter in CONVERTERS:
+        try:
+            warm_converter(converter)
+        except ConversionError as e:
+            print(e)
+
+
+def _resident_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def report_import_times(out=None):
+    """
+    Prints what loading each converter costs: import and warm-up time, modules it pulled in
+    and resident memory added (what preloading lets the workers share).
+    Converters are loaded in order, so modules they share count only once.
+    """
+    print(f"{'converter':<12}{'import ms':>11}{'warm ms':>9}{'modules':>9}{'memory KB':>11}", file=out)
+    for converter in CONVERTERS:
+        modules = len(sys.modules)
+        memory = _resident_bytes()
+        start = time.perf_counter()
+        try:
+            load_converter(converter)
+            loaded = time.perf_counter()
+            warm_converter(converter)
+        except ConversionError as e:
+            print(f"{converter:<12}{e}", file=out)
+            continue
+        warmed = time.perf_counter()
+        print(f"{converter:<12}{(loaded - start) * 1000:>11.1f}{(warmed - loaded) * 1000:>9.1f}"
+              f"{len(sys.modules) - modules:>9}{(_resident_bytes() - memory) / 1024:>11.0f}", file=out)
+
+
+def build_output_path(converter, command, filename, output_dir):
+    """
+    Returns the path of the output file for a converter command.
+    """
+    try:
+        suffix = OUTPUT_SUFFIXES[converter][command]
+    except KeyError:
+        raise ConversionError(f'Unknown command "{command}" for converter "{converter}"')
+
+    if filename.lower().endswith('.asrc.31'):
+        base = filename[:-len('.asrc.31')]
+    else:
+        base = os.path.splitext(filename)[0]
+
+    # Never overwrite the input file (e.g. decoding "bgm.wav" to "bgm.wav")
+    if base + suffix == filename:
+        base += "-out"
+
+    return os.path.join(output_dir, base + suffix)
+
+
+def _run_gmd(module, command, source, output_path, options, progress=None, base=None):
+    if command == "i":
+        ok = module.info_gmd_file(source, output_path)
+    elif command == "d":
+        ok = module.decode_gmd_file(source, output_path, progress=progress)
+    else:
+        ok = module.encode_gmd_file(source, output_path, xor_encoding=_bool_option(options, "xor"), progress=progress)
+
+    if not ok:
+        raise ConversionError("The input file is not a valid GMD script (or text export)")
+
+
+def _run_script(module, command, source, output_path, options, progress=None, base=None):
+    module.convert_file(source, output_path, to_json=command != "e",
+                        isGMD=not _bool_option(options, "pc"), isSOJ=_bool_option(options, "soj"),
+                        isTagsKeep=_bool_option(options, "keeptags"))
+
+
+def _int_option(options, name, required=True):
+    if options.get(name) in (None, "") and not required:
+        return None
+    try:
+        return int(options[name])
+    except (KeyError, TypeError, ValueError):
+        raise ConversionError(f'Option "{name}" is required and must be an integer')
+
+
+def _bool_option(options, name):
+    # Options may come from form fields or query strings ("1", "true", "on")
+    value = options.get(name, False)
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "on", "yes")
+    return bool(value)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _input_file(source, output_path, needs_path=False):
+    """
+    Returns a binary file object for a conversion input (a path or an in-memory file).
+    """
+    if not hasattr(source, 'read'):
+        return open(source, 'rb')
+    if not needs_path:
+        return source
+
+    # The converter needs a real file on disk, so spill the in-memory input next to the output
+    path = output_path + '.in'
+    with open(path, 'wb') as file:
+        shutil.copyfileobj(source, file)
+    return open(path, 'rb')
+
+
+def _run_sounds(module, command, source, output_path, options, progress=None, base=None):
+    # The NSW converter passes the input's file name to ffprobe
+    args = argparse.Namespace(file=_input_file(source, output_path, needs_path=hasattr(module, 'get_ogg_info')),
+                              out=output_path, progress=progress)
+
+    try:
+        if command == "i":
+            with open(output_path, 'w', encoding='utf-8') as out:
+                module.info(args, out=out)
+        elif command == "d":
+            module.decode(args)
+        elif command == "e":
+            args.soff = _bool_option(options, "soff")
+            args.strm = _bool_option(options, "strm")
+            args.lps = _int_option(options, "lps", required=False)
+            args.lpe = _int_option(options, "lpe", required=False)
+            args.mark = options.get("mark")
+            for name in ("id", "unk0", "unk1", "urate"):
+                setattr(args, name, _int_option(options, name))
+            module.encode(args)
+        else:
+            if base is None:
+                raise ConversionError('Replace requires a base asset from the library (option "base")')
+            args.lps = _int_option(options, "lps", required=False)
+            args.lpe = _int_option(options, "lpe", required=False)
+            # replace() hands the markers to encode() as they are, so parse them here
+            args.mark = module.parse_marker_list(options.get("mark")) or None
+            args.cpb = _bool_option(options, "cpb")
+            # Like the CLI's replace, which takes the base file: the NSW converter copies
+            # the data offset bytes of the output from it
+            args.base = open(base["file"], 'rb')
+            # The base file's header was parsed when the library was indexed
+            # (without a parsed header, replace() parses the base file itself, as the CLI does)
+            module.replace(args, base_info=copy.deepcopy(base["header"]) if "header" in base else None)
+    finally:
+        args.file.close()
+        if hasattr(args, 'base'):
+            args.base.close()
+
+
+def read_sounds_header(converter, path):
+    """
+    Parses the header of an .asrc.31 file with the converter's info() and returns its fields.
+    """
+    module = load_converter(converter)
+    try:
+        with open(path, 'rb') as file:
+            header = module.info(argparse.Namespace(file=file), prnt=False)
+    except Exception as e:
+        raise ConversionError(f"{type(e).__name__}: {e}") from e
+    return vars(header)
+
+
+class _StreamReader:
+    """
+    Reads a stream (e.g. a request body) front to back, counting the bytes taken.
+    read() only returns short at the end of the stream, like a file.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def read(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.stream.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return False
+
+
+def read_metadata(converter, stream):
+    """
+    Parses only the header of a GMD or .asrc.31 file from a stream (e.g. an upload still
+    arriving) and returns its fields, without reading any further than the header.
+    The number of bytes read is returned as "header_bytes_read".
+    """
+    if converter not in METADATA_CONVERTERS:
+        raise ConversionError(f'Converter "{converter}" has no header to read')
+
+    module = load_converter(converter)
+    reader = _StreamReader(stream)
+
+    try:
+        if converter == "GMD":
+            metadata = module.read_gmd_header(reader)
+        else:
+            mi, sizes = module.read_header(reader)
+            metadata = vars(mi)
+            if sizes is None:
+                metadata["stub"] = True
+            else:
+                metadata["file_size"], metadata["header_size"], metadata["data_offset"] = sizes
+                if metadata["header_size"] != reader.tell():
+                    raise ValueError("not a valid asrc file")
+    except ConversionError:
+        raise
+    except Exception as e:
+        # e.g. the converters' asserts, or the body ending inside the header
+        raise ConversionError(f"{type(e).__name__}: {e}") from e
+
+    metadata["header_bytes_read"] = reader.tell()
+    return metadata
+
+
+RUNNERS = {
+    "GMD": _run_gmd,
+    "Script": _run_script,
+    "Sounds PC": _run_sounds,
+    "Sounds NSW": _run_sounds
+}
+
+
+def convert(converter, command, source, output_path, options=None, progress=None, base=None):
+    """
+    Runs a converter command in-process and returns the output path.
+    The input can be a path or a binary file object (e.g. an in-memory upload).
+    progress (optional) is called with (done, total) as the converter works:
+    labels processed for GMD, payload bytes copied for Sounds.
+    base is the asset library entry of a Sounds replace.
+    """
+    options = options or {}
+    module = load_converter(converter)
+
+    if command not in OUTPUT_SUFFIXES[converter]:
+        raise ConversionError(f'Unknown command "{command}" for converter "{converter}"')
+
+    ok = False
+    try:
+        RUNNERS[converter](module, command, source, output_path, options, progress, base)
+        ok = True
+    except ConversionError:
+        raise
+    except Exception as e:
+        raise ConversionError(f"{type(e).__name__}: {e}") from e
+    finally:
+        # Never leave the spilled input or a partial output behind (also when interrupted)
+        _remove_file(output_path + '.in')
+        if not ok:
+            _remove_file(output_path)
+
+    if not os.path.isfile(output_path):
+        raise ConversionError("Conversion complete, but no output file was found.")
+
+    return output_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Converter engine diagnostics.")
+    parser.add_argument('--report-import-times', action='store_true',
+                        help="show what importing and warming each converter costs at startup")
+    if parser.parse_args().report_import_times:
+        report_import_times()
+    else:
+        parser.print_help()
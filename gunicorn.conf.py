@@ -0,0 +1,13 @@
+# gunicorn settings (gunicorn reads this file from the working directory)
+import gc
+import os
+
+# Import app.py, and with it every converter and its warmed tables, once in the master.
+# The forked workers share those pages copy-on-write instead of each importing their own.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+
+def pre_fork(server, worker):
+    # Objects that exist before the fork are left alone by the garbage collector,
+    # so collections in the workers do not write to (and copy) the shared pages
+    gc.freeze()
@@ -0,0 +1,237 @@
+import fcntl
+import os
+import shutil
+import threading
+import time
+
+import cache
+import jobs
+import metrics
+from storage import BLOB_FOLDER, BLOB_MAX_BYTES, STAGING_FOLDER, UPLOAD_FOLDER
+
+# Seconds between janitor runs in every worker process (0 disables the background janitor)
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 300))
+
+# Work directories of requests are removed after this many seconds
+UPLOAD_MAX_AGE = int(os.environ.get('UPLOAD_MAX_AGE', 60 * 60))
+
+# Finished jobs (and their results) are kept this many seconds
+JOB_MAX_AGE = int(os.environ.get('JOB_MAX_AGE', 24 * 60 * 60))
+
+# Unfinished resumable uploads are dropped after this many seconds without a new chunk
+STAGING_MAX_AGE = int(os.environ.get('STAGING_MAX_AGE', 24 * 60 * 60))
+
+# Size budget of uploads/, staging/ and jobs/ together, the oldest entries are evicted above it
+DISK_MAX_BYTES = int(os.environ.get('DISK_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Entries younger than this are never evicted (they may not hold their lease yet)
+MIN_AGE = 60
+
+LEASE_FILE = '.lease'
+
+# POSIX record locks belong to the whole process (closing any descriptor of the file drops
+# them), so this process holds one lock per leased directory and counts its leases here:
+# directory -> [lease file descriptor, leases]
+_held = {}
+# Directories this process's janitor is removing
+_removing = set()
+_held_lock = threading.Lock()
+_thread = None
+_thread_lock = threading.Lock()
+
+
+class Lease:
+    """
+    Marks a work directory as in use, so the janitor leaves it alone until released.
+    Any number of leases of one directory may be held at once, the directory stays
+    locked until the last is released. The lock is dropped by the OS if the holding process dies.
+    Raises FileNotFoundError if the directory is being removed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.held = False
+        with _held_lock:
+            if directory in _removing:
+                raise FileNotFoundError(f"{directory} is being removed")
+            entry = _held.get(directory)
+            if entry is not None:
+                entry[1] += 1
+                self.held = True
+                return
+            entry = _held[directory] = [None, 1]
+        self.held = True
+
+        # The first lease of this process takes the lock (waiting while another process holds it)
+        try:
+            fd = os.open(os.path.join(directory, LEASE_FILE), os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            self.release()
+            raise
+        with _held_lock:
+            entry[0] = fd
+
+    def release(self):
+        if not self.held:
+            return
+        self.held = False
+        with _held_lock:
+            entry = _held[self.directory]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _held[self.directory]
+                if entry[0] is not None:
+                    os.close(entry[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _scan(folder, max_age, now):
+    """
+    Returns (last modified, size, path, expired) of every entry in a folder.
+    """
+    entries = []
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return entries
+
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        size = 0 if os.path.isdir(path) else st.st_size
+        mtime = st.st_mtime
+
+        # A directory is as old as its most recently modified file
+        for root, _, files in os.walk(path):
+            for file in files:
+                try:
+                    st = os.stat(os.path.join(root, file))
+                except OSError:
+                    continue
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+
+        entries.append((mtime, size, path, now - mtime > max_age))
+
+    return entries
+
+
+def _remove(path):
+    """
+    Removes an entry unless a request still holds its lease. Returns whether it was removed.
+    """
+    with _held_lock:
+        if path in _held or path in _removing:
+            return False
+        # Reserve it, so this process cannot lease it while it is being removed
+        _removing.add(path)
+
+    fd = None
+    try:
+        if os.path.isdir(path):
+            try:
+                fd = os.open(os.path.join(path, LEASE_FILE), os.O_RDWR)
+            except FileNotFoundError:
+                pass
+            else:
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Leased by another worker process
+                    return False
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        if fd is not None:
+            os.close(fd)
+        with _held_lock:
+            _removing.discard(path)
+
+
+def collect(max_bytes=None, now=None):
+    """
+    Removes expired work directories, abandoned uploads and finished jobs, then the oldest
+    remaining ones while uploads/, staging/ and jobs/ together are over budget. Entries still in use are skipped.
+    Returns the bytes reclaimed per folder (plus the result cache's and blob store's own eviction).
+    The metrics snapshots of exited processes are compacted as well.
+    """
+    max_bytes = DISK_MAX_BYTES if max_bytes is None else max_bytes
+    now = time.time() if now is None else now
+
+    entries = []
+    for folder, max_age in ((UPLOAD_FOLDER, UPLOAD_MAX_AGE), (STAGING_FOLDER, STAGING_MAX_AGE),
+                            (jobs.JOB_FOLDER, JOB_MAX_AGE)):
+        entries += [(mtime, size, path, expired, folder)
+                    for mtime, size, path, expired in _scan(folder, max_age, now)]
+
+    reclaimed = {UPLOAD_FOLDER: 0, STAGING_FOLDER: 0, jobs.JOB_FOLDER: 0}
+    total = sum(entry[1] for entry in entries)
+
+    # Expired entries first, then the oldest ones until the budget fits
+    entries.sort(key=lambda entry: (not entry[3], entry[0]))
+    for mtime, size, path, expired, folder in entries:
+        if not expired and (total <= max_bytes or now - mtime < MIN_AGE):
+            continue
+        if _remove(path):
+            reclaimed[folder] += size
+            total -= size
+
+    reclaimed[cache.CACHE_FOLDER] = cache.evict()
+    reclaimed[BLOB_FOLDER] = cache.evict(BLOB_MAX_BYTES, folder=BLOB_FOLDER)
+
+    # Fold the metrics of exited processes into one file
+    metrics.compact()
+
+    for folder, size in reclaimed.items():
+        if size:
+            metrics.inc("converter_janitor_reclaimed_bytes_total", size, folder=folder)
+    metrics.flush()
+
+    return reclaimed
+
+
+def _loop():
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            reclaimed = collect()
+        except Exception as e:
+            print(f"Janitor failed: {e}")
+            continue
+        if any(reclaimed.values()):
+            print("Janitor reclaimed " + ", ".join(f"{size} bytes from {folder}/"
+                                                   for folder, size in reclaimed.items() if size))
+
+
+def start():
+    """
+    Starts the background janitor of this process (once, and again in a forked child).
+    """
+    global _thread
+    with _thread_lock:
+        if (_thread is None or not _thread.is_alive()) and JANITOR_INTERVAL > 0:
+            _thread = threading.Thread(target=_loop, name="janitor", daemon=True)
+            _thread.start()
+
+
+if __name__ == '__main__':
+    # One-off run, e.g. from cron
+    for folder, size in collect().items():
+        print(f"{folder}/: {size} bytes reclaimed")
@@ -0,0 +1,494 @@
+import fcntl
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import admission
+import cache
+import engine
+import janitor
+import library
+import limits
+import metrics
+from engine import ConversionError
+
+JOB_FOLDER = 'jobs'
+STATUS_FILE = 'status.json'
+
+# Created in a job's directory to cancel it (a separate file, so status updates cannot lose it)
+CANCEL_FILE = 'cancel'
+
+# Locked while a job's status is updated (by pool workers and the web process alike)
+STATUS_LOCK_FILE = '.status.lock'
+
+# Conversion concurrency is sized separately from the HTTP workers
+MAX_JOB_WORKERS = int(os.environ.get('MAX_JOB_WORKERS', os.cpu_count() or 1))
+
+# Pool workers of the fast lane, which runs header-only commands (admission.FAST_LANE_COMMANDS)
+# so they never wait behind the conversions filling the main pool
+FAST_LANE_WORKERS = int(os.environ.get('FAST_LANE_WORKERS', 1))
+
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# Seconds between retries while tasks wait for a slot held by another process
+SLOT_RETRY_INTERVAL = 0.25
+
+# Seconds between progress updates written to a job's status file
+PROGRESS_INTERVAL = 0.5
+
+# An event stream ends after this many seconds (EventSource clients reconnect by themselves),
+# so it never holds a worker or a proxy connection for long
+EVENTS_MAX_SECONDS = int(os.environ.get('EVENTS_MAX_SECONDS', 30))
+
+# Seconds between status checks of an event stream, and between keep-alive comments
+EVENTS_POLL_INTERVAL = 0.5
+EVENTS_KEEPALIVE = 10
+
+_executors = {}
+
+_lock = threading.Lock()
+_futures = {}
+# Tasks waiting for a slot, tasks pending in all, and when the client last got a slot, per client
+_waiting = {}
+_pending = 0
+_client_pending = {}
+_last_turn = {}
+_turns = itertools.count()
+_retry_timer = None
+
+# Held by the thread updating a status file. A pool worker forked meanwhile gets a fresh one.
+_status_lock = threading.Lock()
+
+
+def _reset_status_lock():
+    global _status_lock
+    _status_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_status_lock)
+
+
+def get_executor(fast=False):
+    """
+    Returns the conversion worker pool (or the fast lane's pool) of this process,
+    created on first use, after gunicorn forks.
+    The workers are forked from a process running other threads, so each module lock
+    they take (here, in metrics and in cache) is replaced by a fresh one in the child.
+    """
+    if fast not in _executors:
+        _executors[fast] = ProcessPoolExecutor(max_workers=FAST_LANE_WORKERS if fast else MAX_JOB_WORKERS,
+                                               initializer=limits.init_worker)
+    return _executors[fast]
+
+
+def submit_task(fn, *args, fast=False):
+    """
+    Runs fn(*args) on the worker pool (or the fast lane's pool) and returns its future.
+    """
+    try:
+        return get_executor(fast).submit(fn, *args)
+    except BrokenProcessPool:
+        # Replace a pool whose worker was killed (e.g. out of memory) and try once more
+        _executors.pop(fast, None)
+        return get_executor(fast).submit(fn, *args)
+
+
+def has_capacity(count=1, client=None):
+    """
+    Returns whether this process can take count more tasks (of the client) without
+    exceeding MAX_PENDING_JOBS (or MAX_PENDING_PER_CLIENT).
+    """
+    if _pending + count > admission.MAX_PENDING_JOBS:
+        return False
+    return _client_pending.get(client, 0) + count <= admission.MAX_PENDING_PER_CLIENT
+
+
+def schedule(converter, command, fn, *args, client=None, fast=None):
+    """
+    Queues fn(*args) to run on the worker pool as soon as a slot of the converter is free,
+    and returns a future for its result. Header-only commands (and any task scheduled with
+    fast=True, e.g. metadata_task) start right away in the fast lane.
+    Waiting clients take turns for the slots, so one client's batch cannot starve another's jobs.
+    Raises admission.QueueFullError if too many tasks (or, unless fast, tasks of the client)
+    are already waiting or running.
+    """
+    global _pending
+    future = Future()
+    fast = admission.is_fast(converter, command) if fast is None else fast
+    with _lock:
+        if _pending >= admission.MAX_PENDING_JOBS:
+            raise admission.QueueFullError("Too many conversions are pending, try again later")
+        if not fast and _client_pending.get(client, 0) >= admission.MAX_PENDING_PER_CLIENT:
+            raise admission.QueueFullError("You have too many conversions pending, try again later")
+        _pending += 1
+        _client_pending[client] = _client_pending.get(client, 0) + 1
+        if not fast:
+            _waiting.setdefault(client, deque()).append((converter, future, fn, args))
+
+    if fast:
+        # The fast lane takes no slot of the converter
+        _start(admission.Slot(None, None), client, future, fn, args, fast=True)
+    else:
+        _dispatch()
+    return future
+
+
+def _dispatch():
+    # Start waiting tasks while their converters have free slots. The next slot goes to the
+    # client with the fewest tasks running (then to whoever got one the longest ago).
+    global _retry_timer
+    started = []
+    with _lock:
+        busy = set()
+        taken = True
+        while taken:
+            taken = False
+            turn = lambda client: (_client_pending[client] - len(_waiting[client]), _last_turn.get(client, -1))
+            for client in sorted(_waiting, key=turn):
+                queue = _waiting[client]
+                # The client's oldest task whose converter has a free slot
+                for item in list(queue):
+                    converter, future, fn, args = item
+                    if future.cancelled():
+                        queue.remove(item)
+                        _uncount(client)
+                        continue
+                    if converter in busy:
+                        continue
+                    slot = admission.try_acquire(converter)
+                    if slot is None:
+                        busy.add(converter)
+                        continue
+                    queue.remove(item)
+                    started.append((slot, client, future, fn, args))
+                    _last_turn[client] = next(_turns)
+                    taken = True
+                    break
+                if not queue:
+                    del _waiting[client]
+                if taken:
+                    break
+
+        # Slots freed by other processes are not announced, so poll while anything waits
+        if _waiting and _retry_timer is None:
+            _retry_timer = threading.Timer(SLOT_RETRY_INTERVAL, _retry)
+            _retry_timer.daemon = True
+            _retry_timer.start()
+
+    for slot, client, future, fn, args in started:
+        _start(slot, client, future, fn, args)
+
+
+def _retry():
+    global _retry_timer
+    with _lock:
+        _retry_timer = None
+    _dispatch()
+
+
+def _start(slot, client, future, fn, args, fast=False):
+    if not future.set_running_or_notify_cancel():
+        _release(slot, client)
+        return
+
+    try:
+        task = submit_task(fn, *args, fast=fast)
+    except Exception as e:
+        _release(slot, client)
+        future.set_exception(e)
+        return
+
+    task.add_done_callback(lambda t: _task_done(slot, client, future, t))
+
+
+def _task_done(slot, client, future, task):
+    _release(slot, client)
+    try:
+        result = task.result()
+    except BaseException as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+def _uncount(client):
+    # Called with _lock held
+    global _pending
+    _pending -= 1
+    _client_pending[client] -= 1
+    if not _client_pending[client]:
+        del _client_pending[client]
+        _last_turn.pop(client, None)
+
+
+def _release(slot, client):
+    slot.release()
+    with _lock:
+        _uncount(client)
+    _dispatch()
+
+
+def job_dir(job_id):
+    """
+    Returns the directory of a job, or None if the id is malformed.
+    """
+    if not job_id or not JOB_ID_PATTERN.fullmatch(job_id):
+        return None
+    return os.path.join(JOB_FOLDER, job_id)
+
+
+def write_status(directory, **fields):
+    """
+    Updates the status file of a job (atomically, so readers never see a partial file).
+    Updates are serialized by a lock in the job's directory, so none loses another's fields.
+    """
+    path = os.path.join(directory, STATUS_FILE)
+
+    # The record lock keeps out other processes, _status_lock the other threads of this one
+    with _status_lock:
+        fd = os.open(os.path.join(directory, STATUS_LOCK_FILE), os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            status = read_status(directory) or {}
+            status.update(fields)
+
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as file:
+                    json.dump(status, file)
+                os.replace(tmp_path, path)
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        finally:
+            os.close(fd)
+    return status
+
+
+def read_status(directory):
+    """
+    Returns the status of a job, or None if there is no such job.
+    """
+    try:
+        with open(os.path.join(directory, STATUS_FILE), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def get_status(job_id):
+    directory = job_dir(job_id)
+    return read_status(directory) if directory else None
+
+
+def get_result_path(job_id):
+    """
+    Returns the output file of a finished job, or None.
+    """
+    status = get_status(job_id)
+    if not status or status.get("state") != "done":
+        return None
+    return os.path.join(job_dir(job_id), status["output"])
+
+
+def create_job():
+    """
+    Creates an empty job directory and returns (job_id, directory).
+    """
+    job_id = uuid.uuid4().hex
+    directory = os.path.join(JOB_FOLDER, job_id)
+    os.makedirs(directory)
+    return job_id, directory
+
+
+def convert_task(converter, command, input_path, output_path, options, progress=None, cancelled=None):
+    """
+    Runs a conversion inside a pool worker under the converter's time and memory limits,
+    recording its metrics.
+    """
+    try:
+        with metrics.timed("convert", converter, command), limits.enforced(converter, cancelled):
+            base = library.base_for(converter, command, options)
+            return engine.convert(converter, command, input_path, output_path, options, progress, base)
+    except ConversionError:
+        metrics.inc("converter_failures_total", converter=converter, command=command)
+        raise
+    finally:
+        metrics.flush()
+
+
+def metadata_task(converter, input_path):
+    """
+    Reads the header of a saved file (see engine.read_metadata) inside a pool worker
+    under the converter's time and memory limits, recording its metrics.
+    Only the header is read, whatever the converter, so it belongs in the fast lane.
+    """
+    try:
+        with metrics.timed("convert", converter, "i"), limits.enforced(converter):
+            with open(input_path, 'rb') as file:
+                return engine.read_metadata(converter, file)
+    except ConversionError:
+        metrics.inc("converter_failures_total", converter=converter, command="i")
+        raise
+    finally:
+        metrics.flush()
+
+
+def _progress_writer(directory):
+    # Records the percent complete, at most every PROGRESS_INTERVAL seconds
+    last = {"percent": None, "time": 0}
+
+    def report(done, total):
+        percent = min(100, done * 100 // total) if total else 100
+        now = time.monotonic()
+        if percent != last["percent"] and now - last["time"] >= PROGRESS_INTERVAL:
+            last.update(percent=percent, time=now)
+            write_status(directory, progress=percent)
+
+    return report
+
+
+def run_job(directory, converter, command, input_path, output_path, options, cache_key=None):
+    """
+    Runs a conversion inside a pool worker and records the outcome (and its progress)
+    in the job's status file.
+    """
+    cancelled = lambda: cancel_requested(directory)
+    if cancelled():
+        write_status(directory, state="cancelled", finished=time.time())
+        return
+
+    # Lets any HTTP worker signal this pool worker to cancel the job
+    write_status(directory, state="running", progress=0, worker=limits.worker_token(), started=time.time())
+    try:
+        convert_task(converter, command, input_path, output_path, options, _progress_writer(directory), cancelled)
+    except limits.ConversionCancelledError:
+        write_status(directory, state="cancelled", finished=time.time())
+    except ConversionError as e:
+        write_status(directory, state="failed", error=str(e), finished=time.time())
+    else:
+        if cache_key:
+            cache.store(cache_key, output_path)
+        write_status(directory, state="done", progress=100, finished=time.time())
+
+
+def _job_finished(job_id, directory, lease, future):
+    _futures.pop(job_id, None)
+    lease.release()
+    if future.cancelled():
+        write_status(directory, state="cancelled", finished=time.time())
+    # The pool worker died (or the job never ran), so it could not record the failure itself
+    elif future.exception() is not None:
+        write_status(directory, state="failed", error=str(future.exception()), finished=time.time())
+
+
+def cancel_requested(directory):
+    return os.path.exists(os.path.join(directory, CANCEL_FILE))
+
+
+def cancel(job_id):
+    """
+    Cancels a queued or running job (from any HTTP worker of this node) and returns its status,
+    or None if there is no such job. A job that has already finished is left as it is.
+    """
+    directory = job_dir(job_id)
+    status = read_status(directory) if directory else None
+    if not status or status.get("state") not in ("queued", "running"):
+        return status
+
+    open(os.path.join(directory, CANCEL_FILE), 'w').close()
+
+    # Still waiting in this process: drop it from the queue
+    future = _futures.get(job_id)
+    if future is not None and future.cancel():
+        return read_status(directory)
+
+    # Running: interrupt the pool worker (a queued job elsewhere sees the file when it starts)
+    status = read_status(directory)
+    if status.get("state") == "running" and status.get("worker"):
+        limits.signal_cancel(status["worker"])
+    return status
+
+
+def submit(job_id, converter, command, filename, options=None, cache_key=None, client=None):
+    """
+    Queues the conversion of the job's input file (for the client, see schedule())
+    and returns its status.
+    A job whose result is already cached is done right away.
+    Raises admission.QueueFullError if the job cannot be queued.
+    """
+    directory = job_dir(job_id)
+    input_path = os.path.join(directory, filename)
+    output_path = engine.build_output_path(converter, command, filename, directory)
+
+    status = write_status(directory, id=job_id, state="queued", converter=converter, command=command,
+                          filename=filename, output=os.path.basename(output_path), created=time.time())
+
+    if cache_key and cache.fetch(cache_key, output_path):
+        return write_status(directory, state="done", progress=100, cached=True, finished=time.time())
+
+    # Keep the janitor away from the job's files until it has finished
+    lease = janitor.Lease(directory)
+    try:
+        future = schedule(converter, command, run_job, directory, converter, command, input_path, output_path,
+                          options or {}, cache_key, client=client)
+    except admission.QueueFullError:
+        lease.release()
+        raise
+    _futures[job_id] = future
+    future.add_done_callback(lambda f: _job_finished(job_id, directory, lease, f))
+    return status
+
+
+def status_event_stream(job_id, max_seconds=None):
+    """
+    Yields the status of a job as server-sent events: one "status" event whenever
+    its state or progress changes, until it is done, failed or cancelled (or max_seconds pass).
+    Yields None whenever the caller should wait EVENTS_POLL_INTERVAL seconds (so it can
+    wait without blocking, see status_events() for a blocking stream).
+    """
+    max_seconds = EVENTS_MAX_SECONDS if max_seconds is None else max_seconds
+    start = time.monotonic()
+    last_sent = start
+    last_status = None
+
+    yield f"retry: {int(EVENTS_POLL_INTERVAL * 2000)}\n\n"
+
+    while True:
+        status = get_status(job_id)
+        if status is None:
+            yield "event: error\ndata: {\"error\": \"Unknown job\"}\n\n"
+            return
+
+        if status != last_status:
+            last_status = status
+            last_sent = time.monotonic()
+            yield f"event: status\ndata: {json.dumps(status)}\n\n"
+            if status.get("state") in ("done", "failed", "cancelled"):
+                return
+        elif time.monotonic() - last_sent >= EVENTS_KEEPALIVE:
+            last_sent = time.monotonic()
+            yield ": keep-alive\n\n"
+
+        if time.monotonic() - start >= max_seconds:
+            return
+        yield None
+
+
+def status_events(job_id, max_seconds=None):
+    """
+    Yields the events of status_event_stream(), sleeping between status checks.
+    """
+    for event in status_event_stream(job_id, max_seconds):
+        if event is None:
+            time.sleep(EVENTS_POLL_INTERVAL)
+        else:
+            yield event
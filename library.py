@@ -0,0 +1,168 @@
+import argparse
+import filecmp
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+
+import engine
+from engine import ConversionError
+
+# Original .asrc.31 files that Sounds replace can use as its base (any folder layout)
+LIBRARY_FOLDER = os.environ.get('ASSET_LIBRARY', 'library')
+
+# Parsed headers of the library, rebuilt only for files that changed
+INDEX_FILE = os.environ.get('ASSET_LIBRARY_INDEX', 'library-index.json')
+
+# Payload tag of an .asrc.31 header (bytes 12-16) -> converter that parses it
+PAYLOAD_CONVERTERS = {
+    b'wav ': "Sounds PC",
+    b'ogg ': "Sounds NSW"
+}
+
+_index = None
+_index_mtime = None
+
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _index_entry(path, relpath, st):
+    with open(path, 'rb') as file:
+        converter = PAYLOAD_CONVERTERS.get(file.read(16)[12:])
+    if converter is None:
+        raise ConversionError("not an .asrc.31 file with audio data")
+
+    header = engine.read_sounds_header(converter, path)
+    return {"path": relpath, "converter": converter, "id": header["id"], "size": st.st_size,
+            "mtime": st.st_mtime, "sha256": _file_sha256(path), "header": header}
+
+
+def build_index():
+    """
+    Scans the library and writes its index. Files whose size and modification time
+    are unchanged keep their previous entry, only new or changed ones are parsed.
+    Returns the entries.
+    """
+    previous = {entry["path"]: entry for entry in (_read_index() or [])}
+    entries = []
+
+    for root, _, files in os.walk(LIBRARY_FOLDER):
+        for name in sorted(files):
+            if not name.lower().endswith('.asrc.31'):
+                continue
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, LIBRARY_FOLDER).replace(os.sep, '/')
+            st = os.stat(path)
+
+            entry = previous.get(relpath)
+            if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+                entries.append(entry)
+                continue
+
+            try:
+                entries.append(_index_entry(path, relpath, st))
+            except ConversionError as e:
+                print(f"Skipping library file {relpath}: {e}")
+
+    tmp_path = f"{INDEX_FILE}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(entries, file)
+    os.replace(tmp_path, INDEX_FILE)
+    return entries
+
+
+def _read_index():
+    try:
+        with open(INDEX_FILE, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def get_index():
+    """
+    Returns the library entries, reloading the index when another process rebuilt it.
+    """
+    global _index, _index_mtime
+    try:
+        mtime = os.path.getmtime(INDEX_FILE)
+    except OSError:
+        return []
+
+    if mtime != _index_mtime:
+        _index = _read_index() or []
+        _index_mtime = mtime
+    return _index
+
+
+def find(converter, ref):
+    """
+    Returns the library entry of a converter's asset, named by its id or its path in the library,
+    with the full path of its file as "file". Raises ConversionError if there is no such asset, or the id is not unique.
+    """
+    entries = [entry for entry in get_index() if entry["converter"] == converter]
+
+    if str(ref).isdigit():
+        matches = [entry for entry in entries if entry["id"] == int(ref)]
+        if len(matches) > 1:
+            raise ConversionError(f'Base asset id {ref} is not unique, name it by path instead: '
+                                  + ", ".join(entry["path"] for entry in matches))
+    else:
+        matches = [entry for entry in entries if entry["path"] == str(ref).replace('\\', '/')]
+
+    if not matches:
+        raise ConversionError(f'Unknown base asset "{ref}"')
+    return dict(matches[0], file=os.path.join(LIBRARY_FOLDER, matches[0]["path"]))
+
+
+def base_for(converter, command, options):
+    """
+    Returns the library entry named by the "base" option of a Sounds replace, or None
+    for any other conversion. Raises ConversionError for an unknown base.
+    """
+    if command != "r" or converter not in PAYLOAD_CONVERTERS.values():
+        return None
+    if not options.get("base"):
+        raise ConversionError('Replace requires a base asset from the library (option "base")')
+    return find(converter, options["base"])
+
+
+def check_replace(converter, ref, source, options=None):
+    """
+    Runs a Sounds replace on a library asset twice: as the server does (with the header parsed
+    when the library was indexed) and as the converter's CLI does (parsing the base file).
+    Returns whether both outputs are byte-identical.
+    """
+    entry = find(converter, ref)
+    with tempfile.TemporaryDirectory() as directory:
+        outputs = []
+        for base in (entry, {"file": entry["file"]}):
+            output_path = os.path.join(directory, f"{len(outputs)}.asrc.31")
+            engine.convert(converter, "r", source, output_path, options, base=base)
+            outputs.append(output_path)
+        return filecmp.cmp(outputs[0], outputs[1], shallow=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the index of the asset library.")
+    parser.add_argument('--check-replace', nargs=3, metavar=('CONVERTER', 'BASE', 'INPUT'),
+                        help="also check that replacing the base asset (id or path) with INPUT gives "
+                             "the same file as the converter's CLI")
+    args = parser.parse_args()
+
+    # Rebuild the index, e.g. after adding files to the library
+    for entry in build_index():
+        print(f'{entry["converter"]}: {entry["id"]} {entry["path"]}')
+
+    if args.check_replace:
+        converter, ref, source = args.check_replace
+        same = check_replace(converter, ref, source)
+        print("Replace output matches the CLI" if same else "Replace output differs from the CLI")
+        raise SystemExit(0 if same else 1)
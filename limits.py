@@ -0,0 +1,203 @@
+import os
+import resource
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+from engine import ConversionError
+
+# Wall-clock seconds a conversion may take, per converter (0 = no limit),
+# e.g. CONVERTER_TIMEOUT_SOUNDS_NSW=120
+DEFAULT_TIMEOUTS = {
+    "GMD": 60,
+    "Script": 60,
+    "Sounds PC": 300,
+    "Sounds NSW": 300
+}
+
+# Memory a pool worker may allocate while converting, on top of what it had when the
+# conversion started (e.g. inherited from its parent), per converter (0 = no limit),
+# e.g. CONVERTER_MEMORY_SOUNDS_PC=1073741824
+DEFAULT_MEMORY_LIMITS = {
+    "GMD": 1024 * 1024 * 1024,
+    "Script": 1024 * 1024 * 1024,
+    "Sounds PC": 2 * 1024 * 1024 * 1024,
+    "Sounds NSW": 2 * 1024 * 1024 * 1024
+}
+
+# Sent to a pool worker to cancel the job it is running (SIGUSR1 is taken by gunicorn)
+CANCEL_SIGNAL = signal.SIGUSR2
+
+_cancelled = None
+
+
+class ConversionTimeoutError(ConversionError):
+    """Raised when a conversion runs longer than its converter's time limit."""
+
+
+class ConversionCancelledError(ConversionError):
+    """Raised when a running conversion is cancelled."""
+
+
+class _Interrupt(BaseException):
+    # Raised from the signal handlers. Not an Exception, so the converters'
+    # own "except Exception" blocks cannot swallow it.
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+def _limit(defaults, prefix, converter):
+    name = prefix + converter.upper().replace(' ', '_')
+    return int(os.environ.get(name, defaults.get(converter, 0)))
+
+
+def timeout_for(converter):
+    return _limit(DEFAULT_TIMEOUTS, 'CONVERTER_TIMEOUT_', converter)
+
+
+def memory_limit_for(converter):
+    return _limit(DEFAULT_MEMORY_LIMITS, 'CONVERTER_MEMORY_', converter)
+
+
+def _on_alarm(signum, frame):
+    raise _Interrupt(ConversionTimeoutError("The conversion took too long and was stopped"))
+
+
+def _on_cancel(signum, frame):
+    # A late signal (the job already finished) is ignored
+    if _cancelled and _cancelled():
+        raise _Interrupt(ConversionCancelledError("The conversion was cancelled"))
+
+
+def init_worker():
+    """
+    Initializer of the conversion pool workers: lets them be cancelled by CANCEL_SIGNAL.
+    """
+    signal.signal(CANCEL_SIGNAL, _on_cancel)
+
+
+def _start_time(pid):
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as file:
+            return file.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def worker_token():
+    """
+    Returns an id of this process that stays unique even if its pid is reused later.
+    """
+    return f"{os.getpid()}:{_start_time(os.getpid())}"
+
+
+def signal_cancel(token):
+    """
+    Sends CANCEL_SIGNAL to the pool worker of a worker_token(), if it is still running.
+    """
+    pid, start_time = token.split(':', 1)
+    if _start_time(pid) != start_time or start_time == 'None':
+        return
+    try:
+        os.kill(int(pid), CANCEL_SIGNAL)
+    except OSError:
+        pass
+
+
+def _boot_ticks():
+    # Now, in the clock ticks since boot of the start times in /proc/<pid>/stat
+    return int(time.clock_gettime(time.CLOCK_BOOTTIME) * os.sysconf('SC_CLK_TCK'))
+
+
+def _data_size():
+    # Bytes of this process's data segment (what RLIMIT_DATA counts), read from /proc
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmData:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _child_pids(started=0):
+    # Children of this process started since the given boot tick (e.g. ffprobe started
+    # by the NSW converter), read from /proc
+    pid = str(os.getpid())
+    children = set()
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return children
+
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'r') as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if fields[1] == pid and int(fields[19]) >= started:
+            children.add(int(name))
+    return children
+
+
+@contextmanager
+def enforced(converter, cancelled=None, memory=True):
+    """
+    Runs the block under the converter's time limit (if on the main thread, which is
+    where signals arrive) and memory limit (unless memory is False, e.g. in an HTTP worker).
+    cancelled (optional) returns whether the job was cancelled, it is checked on entry and
+    when CANCEL_SIGNAL arrives. Processes left behind by a stopped conversion are killed.
+    Raises ConversionTimeoutError, ConversionCancelledError or ConversionError (out of memory).
+    """
+    global _cancelled
+    if cancelled and cancelled():
+        raise ConversionCancelledError("The conversion was cancelled")
+
+    timeout = timeout_for(converter) if threading.current_thread() is threading.main_thread() else 0
+    memory_limit = memory_limit_for(converter) if memory else 0
+    started = _boot_ticks()
+
+    previous_limit = None
+    if memory_limit:
+        # RLIMIT_DATA counts the heap and private writable mappings, not the whole address space
+        # (most of which a worker forked from a threaded parent has reserved before converting)
+        previous_limit = resource.getrlimit(resource.RLIMIT_DATA)
+        soft, hard = _data_size() + memory_limit, previous_limit[1]
+        resource.setrlimit(resource.RLIMIT_DATA, (soft if hard == resource.RLIM_INFINITY
+                                                  else min(soft, hard), hard))
+
+    previous_handler = None
+    if timeout:
+        previous_handler = signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    _cancelled = cancelled
+
+    try:
+        yield
+    except _Interrupt as e:
+        # Kill whatever the converter was waiting on (e.g. a hanging ffprobe)
+        for pid in _child_pids(started):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        raise e.error from None
+    except MemoryError:
+        raise ConversionError(f"The conversion ran out of memory (limit {memory_limit} bytes)") from None
+    except ConversionError as e:
+        if isinstance(e.__cause__, MemoryError):
+            raise ConversionError(f"The conversion ran out of memory (limit {memory_limit} bytes)") from None
+        raise
+    finally:
+        _cancelled = None
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+        if previous_limit:
+            resource.setrlimit(resource.RLIMIT_DATA, previous_limit)
@@ -0,0 +1,267 @@
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Every process (HTTP workers and conversion pool workers) writes its own snapshot here,
+# and /metrics adds them all up
+METRICS_FOLDER = 'metrics'
+
+# The snapshots of processes that have exited, added up by compact()
+AGGREGATE_FILE = 'aggregate.json'
+
+# Locked while the snapshots are read or compacted
+LOCK_FILE = '.lock'
+
+SNAPSHOT_PATTERN = re.compile(r"(\d+)-[0-9a-f]{32}\.json(\.tmp)?")
+
+# Histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    "converter_requests_total": ("counter", "Conversion requests, by converter, command and endpoint."),
+    "converter_upload_bytes_total": ("counter", "Bytes uploaded for conversion."),
+    "converter_failures_total": ("counter", "Failed conversions."),
+    "converter_cache_hits_total": ("counter", "Conversions served from the result cache."),
+    "converter_response_bytes_total": ("counter", "Bytes of output files sent, by content encoding."),
+    "converter_phase_seconds": ("histogram", "Wall time per request phase (save, convert, locate, send)."),
+    "converter_janitor_reclaimed_bytes_total": ("counter", "Bytes of old uploads, jobs and cached results removed by the janitor."),
+}
+
+_lock = threading.Lock()
+_pid = None
+_snapshot_path = None
+_counters = {}
+_histograms = {}
+# Held by the thread reading or compacting the snapshots
+_folder_lock = threading.Lock()
+
+
+def _reset_lock():
+    # A pool worker forked while another thread held a lock would wait for it forever
+    global _lock, _folder_lock
+    _lock = threading.Lock()
+    _folder_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock)
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+def _check_process():
+    # A forked child inherits the parent's values, start it from zero with its own snapshot
+    global _pid, _snapshot_path
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _snapshot_path = os.path.join(METRICS_FOLDER, f"{_pid}-{uuid.uuid4().hex}.json")
+        _counters.clear()
+        _histograms.clear()
+
+
+def inc(name, value=1, **labels):
+    """
+    Adds to a counter.
+    """
+    with _lock:
+        _check_process()
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """
+    Records a duration in a histogram.
+    """
+    with _lock:
+        _check_process()
+        key = _key(name, labels)
+        histogram = _histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+
+@contextmanager
+def timed(phase, converter, command):
+    """
+    Records the wall time of a request phase.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("converter_phase_seconds", time.perf_counter() - start,
+                converter=converter, command=command, phase=phase)
+
+
+def flush():
+    """
+    Writes this process's metrics to its snapshot file.
+    """
+    with _lock:
+        _check_process()
+        data = {"counters": _counters, "histograms": _histograms}
+        os.makedirs(METRICS_FOLDER, exist_ok=True)
+        tmp_path = _snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, _snapshot_path)
+
+
+@contextmanager
+def _locked_folder():
+    # The record lock keeps out other processes, _folder_lock the other threads of this one
+    with _folder_lock:
+        os.makedirs(METRICS_FOLDER, exist_ok=True)
+        fd = os.open(os.path.join(METRICS_FOLDER, LOCK_FILE), os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+
+def _read(name):
+    try:
+        with open(os.path.join(METRICS_FOLDER, name), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _add(counters, histograms, data):
+    for key, value in data.get("counters", {}).items():
+        counters[key] = counters.get(key, 0) + value
+    for key, values in data.get("histograms", {}).items():
+        total = histograms.setdefault(key, [0] * len(values))
+        for i, value in enumerate(values):
+            total[i] += value
+
+
+def _collect():
+    counters = {}
+    histograms = {}
+
+    with _locked_folder():
+        aggregate = _read(AGGREGATE_FILE) or {}
+        merged = set(aggregate.get("merged", ()))
+        _add(counters, histograms, aggregate)
+
+        for name in os.listdir(METRICS_FOLDER):
+            if not name.endswith('.json') or name == AGGREGATE_FILE or name in merged:
+                continue
+            data = _read(name)
+            if data is not None:
+                _add(counters, histograms, data)
+
+    return counters, histograms
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. owned by another user
+        pass
+    return True
+
+
+def compact():
+    """
+    Adds the snapshots of processes that have exited (pool workers replaced, HTTP workers
+    restarted) to the aggregate file and removes them, so /metrics does not read a file for
+    every process ever started. Returns the number of snapshots removed.
+    """
+    with _locked_folder():
+        aggregate = _read(AGGREGATE_FILE) or {}
+        counters = aggregate.get("counters", {})
+        histograms = aggregate.get("histograms", {})
+
+        # Added by the last run already, which stopped before removing them
+        previous = aggregate.get("merged", [])
+        for name in previous:
+            try:
+                os.remove(os.path.join(METRICS_FOLDER, name))
+            except OSError:
+                pass
+
+        dead = []
+        for name in os.listdir(METRICS_FOLDER):
+            match = SNAPSHOT_PATTERN.fullmatch(name)
+            if not match or _is_running(int(match.group(1))):
+                continue
+            if not match.group(2):
+                data = _read(name)
+                if data is not None:
+                    _add(counters, histograms, data)
+            dead.append(name)
+
+        if not dead and not previous:
+            return 0
+
+        # Listed as merged until they are removed, so they are never counted twice
+        path = os.path.join(METRICS_FOLDER, AGGREGATE_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({"counters": counters, "histograms": histograms, "merged": dead}, file)
+        os.replace(tmp_path, path)
+
+        for name in dead:
+            try:
+                os.remove(os.path.join(METRICS_FOLDER, name))
+            except OSError:
+                pass
+
+    return len(dead)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+
+def render():
+    """
+    Returns the metrics of all processes in the Prometheus text format.
+    """
+    flush()
+    counters, histograms = _collect()
+
+    series = {}
+    for key, value in counters.items():
+        name, labels = json.loads(key)
+        series.setdefault(name, []).append((labels, value))
+    for key, values in histograms.items():
+        name, labels = json.loads(key)
+        series.setdefault(name, []).append((labels, values))
+
+    lines = []
+    for name in sorted(series):
+        kind, text = HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(series[name], key=lambda s: s[0]):
+            if kind != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            for bound, count in zip(BUCKETS, value):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,325 @@
+import fcntl
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+
+UPLOAD_FOLDER = 'uploads'
+
+# Uploaded inputs by sha256 (blobs/<sha256[:2]>/<sha256>), so clients can skip re-uploading them
+BLOB_FOLDER = 'blobs'
+
+# Size budget of the blob store, the least recently used blobs are evicted above it
+BLOB_MAX_BYTES = int(os.environ.get('BLOB_MAX_BYTES', 1024 * 1024 * 1024))
+
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+# Resumable uploads are assembled here, one directory per upload
+STAGING_FOLDER = 'staging'
+STAGED_DATA = 'data'
+STAGED_META = 'meta.json'
+# Locked while a chunk is appended to an upload, or the upload is taken
+STAGED_LOCK = '.lock'
+
+UPLOAD_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# Uploads up to this size are converted from memory, larger ones are spilled to disk
+UPLOAD_SPOOL_BYTES = int(os.environ.get('UPLOAD_SPOOL_BYTES', 4 * 1024 * 1024))
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def save_upload(stream, path):
+    """
+    Saves an uploaded file stream while hashing it, and returns its sha256 (hex).
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'wb') as out:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            out.write(chunk)
+    return sha256.hexdigest()
+
+
+def spool_upload(stream, path, threshold=None):
+    """
+    Reads an uploaded file stream while hashing it. Small uploads stay in memory,
+    anything above the threshold is spilled to the given path.
+    Returns (source, sha256, size), where source is an in-memory file or the path.
+    """
+    threshold = UPLOAD_SPOOL_BYTES if threshold is None else threshold
+    sha256 = hashlib.sha256()
+    buffer = io.BytesIO()
+    out = None
+    size = 0
+
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            size += len(chunk)
+
+            if out is None and size > threshold:
+                # Over the threshold: move what we have so far to disk and continue there
+                out = open(path, 'wb')
+                out.write(buffer.getbuffer())
+                buffer = None
+
+            (out or buffer).write(chunk)
+    finally:
+        if out is not None:
+            out.close()
+
+    if out is not None:
+        return path, sha256.hexdigest(), size
+
+    buffer.seek(0)
+    return buffer, sha256.hexdigest(), size
+
+
+def _blob_path(sha256):
+    return os.path.join(BLOB_FOLDER, sha256[:2], sha256)
+
+
+def find_blob(sha256):
+    """
+    Returns the path of a stored upload (marking it as recently used), or None.
+    """
+    if not sha256 or not SHA256_PATTERN.fullmatch(sha256):
+        return None
+    path = _blob_path(sha256)
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def store_blob(source, sha256):
+    """
+    Keeps an upload (a path, linked if possible, or an in-memory file) in the blob store.
+    """
+    path = _blob_path(sha256)
+    if os.path.exists(path):
+        os.utime(path)
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        if hasattr(source, 'getbuffer'):
+            with open(tmp_path, 'wb') as file:
+                file.write(source.getbuffer())
+        else:
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not store upload: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def fetch_blob(sha256, path):
+    """
+    Places a stored upload at the given path. Returns False if it is not stored.
+    """
+    blob = find_blob(sha256)
+    if not blob:
+        return False
+    try:
+        os.link(blob, path)
+    except FileNotFoundError:
+        # Evicted in the meantime
+        return False
+    except OSError:
+        shutil.copyfile(blob, path)
+    return True
+
+
+class StagedUploadError(Exception):
+    """Raised for a chunk that does not fit a resumable upload."""
+
+
+class UploadOffsetError(StagedUploadError):
+    """Raised when a chunk does not start at the current end of the upload."""
+
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+def staging_dir(upload_id):
+    """
+    Returns the directory of a resumable upload, or None if the id is malformed.
+    """
+    if not upload_id or not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+        return None
+    return os.path.join(STAGING_FOLDER, upload_id)
+
+
+# Upload id -> [lock, users] of the uploads that threads of this process are changing
+_upload_locks = {}
+_upload_locks_lock = threading.Lock()
+
+
+class UploadLock:
+    """
+    Serializes the changes to one resumable upload (appending chunks, taking it): across the
+    threads of this process with a lock per upload, across processes with a record lock
+    (which alone would not keep out other threads, it belongs to the whole process).
+    acquire() waits for the lock, release() never blocks (so an event loop can call it).
+    Raises FileNotFoundError if the upload is gone.
+    """
+
+    def __init__(self, upload_id):
+        self.upload_id = upload_id
+        self.held = False
+
+    def acquire(self):
+        with _upload_locks_lock:
+            self.entry = _upload_locks.setdefault(self.upload_id, [threading.Lock(), 0])
+            self.entry[1] += 1
+        self.entry[0].acquire()
+
+        fd = None
+        try:
+            fd = os.open(os.path.join(staging_dir(self.upload_id), STAGED_LOCK), os.O_CREAT | os.O_RDWR)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            self._unlock()
+            raise
+        self.fd = fd
+        self.held = True
+        return self
+
+    def release(self):
+        if not self.held:
+            return
+        self.held = False
+        os.close(self.fd)
+        self._unlock()
+
+    def _unlock(self):
+        self.entry[0].release()
+        with _upload_locks_lock:
+            self.entry[1] -= 1
+            if self.entry[1] == 0:
+                del _upload_locks[self.upload_id]
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def create_staged_upload(filename, size=None):
+    """
+    Starts a resumable upload (of a known total size, if given) and returns its id.
+    """
+    upload_id = uuid.uuid4().hex
+    directory = os.path.join(STAGING_FOLDER, upload_id)
+    os.makedirs(directory)
+    open(os.path.join(directory, STAGED_DATA), 'wb').close()
+    with open(os.path.join(directory, STAGED_META), 'w', encoding='utf-8') as file:
+        json.dump({"filename": filename, "size": size}, file)
+    return upload_id
+
+
+def get_staged_upload(upload_id):
+    """
+    Returns the file name, total size (or None) and current offset of a resumable upload,
+    or None if there is no such upload.
+    """
+    directory = staging_dir(upload_id)
+    if not directory:
+        return None
+    try:
+        with open(os.path.join(directory, STAGED_META), 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        meta["offset"] = os.path.getsize(os.path.join(directory, STAGED_DATA))
+    except (OSError, ValueError):
+        return None
+    return meta
+
+
+def check_chunk(upload_id, offset, max_size):
+    """
+    Checks that a chunk can be appended at the given offset of a resumable upload.
+    Returns (data file path, size limit). Raises like append_chunk().
+    """
+    meta = get_staged_upload(upload_id)
+    if meta is None:
+        raise FileNotFoundError(f"No upload {upload_id}")
+    if offset != meta["offset"]:
+        raise UploadOffsetError(f"The upload is at offset {meta['offset']}", meta["offset"])
+
+    limit = meta["size"] if meta["size"] is not None else max_size
+    return os.path.join(staging_dir(upload_id), STAGED_DATA), limit
+
+
+def write_chunk(out, data, offset, start, limit):
+    """
+    Writes part of a chunk to the open data file and returns the new offset. If the upload
+    would grow beyond limit, the chunk (from start on) is dropped and StagedUploadError is raised.
+    """
+    if offset + len(data) > limit:
+        out.truncate(start)
+        raise StagedUploadError(f"The upload is larger than {limit} bytes")
+    out.write(data)
+    return offset + len(data)
+
+
+def append_chunk(upload_id, offset, stream, max_size):
+    """
+    Appends a chunk at the given offset of a resumable upload and returns the new offset.
+    What arrived before a dropped connection is kept, so the client can resume from there.
+    Raises UploadOffsetError if the offset is not the current end of the upload,
+    and StagedUploadError if the upload would grow beyond its size (or max_size).
+    """
+    path, limit = check_chunk(upload_id, offset, max_size)
+    start = offset
+
+    with open(path, 'ab') as out:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            offset = write_chunk(out, chunk, offset, start, limit)
+
+    return offset
+
+
+def take_staged_upload(upload_id, path):
+    """
+    Moves a completed resumable upload to the given path (a rename, not a copy),
+    removes its staging directory and returns (sha256, size).
+    """
+    directory = staging_dir(upload_id)
+    os.replace(os.path.join(directory, STAGED_DATA), path)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size